@@ -0,0 +1,107 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import logging
+from flask import g, request
+from flask_babel import gettext
+
+from app import app, csrf
+from functions import parse_broadcast_json, token_required, wake_job_workers
+from jobs import create_jobs, get_job
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@app.route("/api/broadcasts", methods=["POST"], endpoint="api_broadcasts")
+@csrf.exempt
+@token_required
+async def broadcasts():
+    """
+    Queues broadcasts sent as JSON by machine clients.
+
+    The body is a broadcast object as described in parse_broadcast_json, or
+    an object with a list of them under "broadcasts". Either all broadcasts
+    are queued or, if one is invalid, none.
+
+    Returns:
+        tuple: The ID of every job in order, with status code 202, or an error with the index of the invalid broadcast.
+    """
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and "broadcasts" in data:
+        items = data["broadcasts"]
+    else:
+        items = [data]
+    if not isinstance(items, list) or not items:
+        return {
+            "error": gettext("Invalid field %(field)s!") % {"field": "broadcasts"}
+        }, 400
+    if len(items) > app.config.get("API_MAX_BROADCASTS", 100):
+        return {
+            "error": gettext("At most %(count)d broadcasts per request!")
+            % {"count": app.config.get("API_MAX_BROADCASTS", 100)}
+        }, 413
+
+    jobs = []
+    for index, item in enumerate(items):
+        try:
+            payload, scheduled = parse_broadcast_json(item, g.user)
+            key = item.get("idempotency_key", None)
+            if key is not None and not isinstance(key, str):
+                raise ValueError(
+                    gettext("Invalid field %(field)s!") % {"field": "idempotency_key"}
+                )
+        except ValueError as e:
+            return {"error": str(e), "index": index}, 400
+        jobs.append((payload, key, scheduled))
+
+    created = create_jobs(g.user.get("username", ""), jobs)
+    wake_job_workers()
+    logger.info(
+        "Queued %d broadcasts for %s via the API",
+        sum(new for _, new in created),
+        g.user.get("username", ""),
+    )
+    return {
+        "jobs": [
+            {"id": job_id, "created": new, "scheduled": scheduled}
+            for (job_id, new), (_, _, scheduled) in zip(created, jobs)
+        ]
+    }, 202
+
+
+@app.route("/api/broadcasts/<job_id>", endpoint="api_broadcast")
+@token_required
+async def broadcast(job_id):
+    """
+    Reports the progress of a broadcast job queued by the user of the token.
+
+    Args:
+        job_id (str): The ID of the job.
+
+    Returns:
+        dict: The status of the job and its counts.
+    """
+    data = get_job(job_id)
+    if data is None or data["username"] != g.user.get("username", ""):
+        return {"error": gettext("Job not found.")}, 404
+    return data
@@ -18,14 +18,18 @@ along with Signal Broadcaster. If not, see
 <https://www.gnu.org/licenses/>.
 """
 
+import gc
 import json
 import logging
 import os
 import yaml
-from datetime import datetime
+from datetime import datetime, timezone
 from flask import Flask, session
-from flask_babel import Babel, _
+from flask_babel import Babel, _, force_locale, get_translations
 from flask_wtf import CSRFProtect
+from jinja2 import FileSystemBytecodeCache, TemplateError
+
+from assets import register_assets
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -42,18 +46,110 @@ app.config.update(
     SESSION_COOKIE_HTTPONLY=True,
     SESSION_COOKIE_SAMESITE="Lax",
     BABEL_DEFAULT_LOCALE="en",
+    # Maximum number of open connections to the Signal API
+    API_CONNECTION_LIMIT=int(os.getenv("APP_API_CONNECTION_LIMIT", "32")),
+    # Maximum number of upstream requests a job hands to the client at once;
+    # after a crash, these are the messages that may or may not have been sent
+    SEND_WINDOW=int(os.getenv("APP_SEND_WINDOW", "64")),
+    # Maximum number of upstream requests in flight per sender number
+    SEND_CONCURRENCY=int(os.getenv("APP_SEND_CONCURRENCY", "8")),
+    # Messages per second and sender number; lowered while the API answers 429
+    SEND_RATE=float(os.getenv("APP_SEND_RATE", "5")),
+    SEND_RATE_MIN=float(os.getenv("APP_SEND_RATE_MIN", "0.2")),
+    SEND_RATE_INCREASE=float(os.getenv("APP_SEND_RATE_INCREASE", "0.1")),
+    SEND_BURST=float(os.getenv("APP_SEND_BURST", "10")),
+    # Retries of failed requests with exponential backoff
+    SEND_RETRIES=int(os.getenv("APP_SEND_RETRIES", "5")),
+    SEND_BACKOFF_BASE=float(os.getenv("APP_SEND_BACKOFF_BASE", "0.5")),
+    SEND_BACKOFF_MAX=float(os.getenv("APP_SEND_BACKOFF_MAX", "30")),
+    # Share of requests that may be retried, and the maximum saved retries
+    RETRY_BUDGET_RATIO=float(os.getenv("APP_RETRY_BUDGET_RATIO", "0.2")),
+    RETRY_BUDGET_MAX=float(os.getenv("APP_RETRY_BUDGET_MAX", "100")),
+    # Maximum number of recipients of one request with an identical message
+    SEND_BATCH_SIZE=int(os.getenv("APP_SEND_BATCH_SIZE", "50")),
+    # Base URL of the signal-cli-rest-api
+    API_URL=os.getenv("APP_API_URL", "http://api"),
+    # Connect and read timeouts of API requests in seconds
+    API_CONNECT_TIMEOUT=float(os.getenv("APP_API_CONNECT_TIMEOUT", "3")),
+    API_READ_TIMEOUT=float(os.getenv("APP_API_READ_TIMEOUT", "15")),
+    API_ACCOUNTS_TIMEOUT=float(os.getenv("APP_API_ACCOUNTS_TIMEOUT", "5")),
+    API_SEND_TIMEOUT=float(os.getenv("APP_API_SEND_TIMEOUT", "60")),
+    # Failures in a row that open the circuit breaker, and its cooldown
+    API_BREAKER_THRESHOLD=int(os.getenv("APP_API_BREAKER_THRESHOLD", "5")),
+    API_BREAKER_COOLDOWN=float(os.getenv("APP_API_BREAKER_COOLDOWN", "30")),
+    # Seconds the list of linked accounts is cached
+    ACCOUNTS_CACHE_TTL=float(os.getenv("APP_ACCOUNTS_CACHE_TTL", "60")),
+    # Seconds after which an unlinked number is checked against the API again
+    ACCOUNTS_RECHECK_INTERVAL=float(os.getenv("APP_ACCOUNTS_RECHECK_INTERVAL", "2")),
+    # Directory of the job queue and other persistent state
+    DATA_DIR=os.getenv("APP_DATA_DIR", "data"),
+    # Maximum size of a submitted form including attachments, in bytes
+    MAX_CONTENT_LENGTH=int(os.getenv("APP_MAX_UPLOAD_SIZE", str(100 * 1024 * 1024))),
+    # Number of progress streams a worker process serves at a time; keep it
+    # below the uWSGI threads, so other requests are still answered
+    EVENT_STREAMS=int(os.getenv("APP_EVENT_STREAMS", "8")),
+    # Number of background threads sending queued broadcasts
+    JOB_WORKERS=int(os.getenv("APP_JOB_WORKERS", "2")),
+    # Seconds of recipients a paced broadcast sends per run; in between, the
+    # job goes back to the queue and the worker takes other jobs
+    PACE_INTERVAL=float(os.getenv("APP_PACE_INTERVAL", "1")),
+    # Seconds between two looks at the job queue while it is empty
+    JOB_POLL_INTERVAL=float(os.getenv("APP_JOB_POLL_INTERVAL", "5")),
+    # Number of recipients whose messages are rendered when planning a broadcast
+    PLAN_SAMPLE_SIZE=int(os.getenv("APP_PLAN_SAMPLE_SIZE", "20")),
+    # Maximum number of broadcasts queued by one request to the API
+    API_MAX_BROADCASTS=int(os.getenv("APP_API_MAX_BROADCASTS", "100")),
+    # Seconds between two fetches of receipts and replies, 0 to disable
+    RECEIVE_INTERVAL=float(os.getenv("APP_RECEIVE_INTERVAL", "10")),
+    # Maximum number of messages fetched at once
+    RECEIVE_BATCH_SIZE=int(os.getenv("APP_RECEIVE_BATCH_SIZE", "100")),
+    # Seconds after a message in which replies without a quote count for it
+    RECEIVE_REPLY_WINDOW=float(os.getenv("APP_RECEIVE_REPLY_WINDOW", "86400")),
+    # Seconds between two checks of users.yaml and contacts.yaml for changes
+    CONTACTS_RELOAD_INTERVAL=float(os.getenv("APP_CONTACTS_RELOAD_INTERVAL", "10")),
+    # Seconds between two publications of the metrics of a worker process
+    METRICS_PUBLISH_INTERVAL=float(os.getenv("APP_METRICS_PUBLISH_INTERVAL", "5")),
+    # Name of the uWSGI cache holding the state shared by worker processes
+    SHARED_CACHE=os.getenv("APP_SHARED_CACHE", "shared"),
 )
+
+# Compiled templates are cached on disk, so new workers only load them; this
+# must be set before the Jinja environment is created
+jinja_cache_dir = os.path.join(app.config["DATA_DIR"], "cache", "jinja")
+os.makedirs(jinja_cache_dir, exist_ok=True)
+app.jinja_options = {
+    **app.jinja_options,
+    "bytecode_cache": FileSystemBytecodeCache(jinja_cache_dir),
+}
+
 csrf = CSRFProtect(app)
+register_assets(app)
 
 import public_routes
 import protected_routes
-from functions import get_locale
-from variables import contacts, groups
-
+import api_routes
+from functions import get_locale, start_job_workers
+from metrics import start_metrics_publisher
+from receiver import start_receiver
+from shared import run_in_workers
+from variables import start_contacts_watcher
 
 babel = Babel(app, locale_selector=get_locale)
 
 
+def start_background_threads():
+    """
+    Starts the job workers, the contacts watcher, the receiver and the metrics publisher.
+    """
+    start_job_workers()
+    start_contacts_watcher()
+    start_receiver()
+    start_metrics_publisher()
+
+
+run_in_workers(start_background_threads)
+
+
 @app.context_processor
 def context_processor():
     """
@@ -73,8 +169,6 @@ def context_processor():
     }
 
     if session.get("logged_in", False):
-        data["contacts"] = contacts
-        data["groups"] = groups
         data["session"] = session
 
     return data
@@ -114,6 +208,43 @@ def template_filter_yaml(data):
         return "Failed to serialize " + type(data).__name__ + "."
 
 
+@app.template_filter("timestamp_iso")
+def template_filter_timestamp_iso(timestamp):
+    """
+    Converts a Unix time to an ISO 8601 string in UTC for use in templates.
+
+    Args:
+        timestamp (float): The Unix time.
+
+    Returns:
+        str: The time in ISO 8601 format.
+    """
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec="minutes")
+
+
+def warm_caches():
+    """
+    Compiles all templates and loads all translations before the first request.
+    """
+    for name in app.jinja_env.list_templates():
+        try:
+            app.jinja_env.get_template(name)
+        except TemplateError as e:
+            logger.error("Failed to compile template %s: %s", name, e)
+    with app.app_context():
+        for language in app.config.get("LANGUAGES", []):
+            with force_locale(language):
+                get_translations()
+
+
+warm_caches()
+
+# Everything loaded so far, like the contacts, is shared copy-on-write with
+# the worker processes uWSGI forks; keep the garbage collector from writing
+# to those pages
+gc.freeze()
+
+
 # Run the Flask application in debug mode
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,187 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import sys
+from flask import Flask, abort, current_app, request, send_file
+from logging import getLogger
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = getLogger(__name__)
+
+# Extensions of the static files that are stored compressed as well
+COMPRESSIBLE = (".css", ".js", ".svg", ".html", ".json", ".txt")
+
+# Precompressed variants, in order of preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+# Fingerprinted file names, e.g. "style.0123456789ab.css"
+FINGERPRINTED = re.compile(r"^(?P<name>.+)\.[0-9a-f]{12}(?P<ext>\.[^./]+)$")
+
+# Seconds browsers may cache fingerprinted files
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Fingerprinted names of the static files, and the files they refer to
+_fingerprints: dict[str, str] = {}
+_originals: dict[str, str] = {}
+
+
+def build_assets(directory: str) -> dict[str, str]:
+    """
+    Fingerprints the static files and stores compressed variants next to them.
+
+    Variants are only written if they are missing or older than their file,
+    so this is cheap when the files were built ahead of time.
+
+    Args:
+        directory (str): The directory of the static files.
+
+    Returns:
+        dict: The fingerprinted name of every file, by file name.
+    """
+    fingerprints = {}
+    for root, _, files in os.walk(directory):
+        for file in files:
+            if file.endswith(tuple(suffix for _, suffix in ENCODINGS)):
+                continue
+            path = os.path.join(root, file)
+            with open(path, "rb") as f:
+                data = f.read()
+            name = os.path.relpath(path, directory).replace(os.sep, "/")
+            stem, ext = os.path.splitext(name)
+            fingerprints[name] = "%s.%s%s" % (
+                stem,
+                hashlib.sha256(data).hexdigest()[:12],
+                ext,
+            )
+            if ext in COMPRESSIBLE:
+                try:
+                    _compress(path, data)
+                except OSError as e:
+                    logger.warning("Failed to compress %s: %s", name, e)
+    return fingerprints
+
+
+def _compress(path: str, data: bytes):
+    """
+    Writes the gzip and, if available, brotli variants of a file.
+
+    Args:
+        path (str): The path of the file.
+        data (bytes): The content of the file.
+    """
+    compressors = {"gzip": lambda data: gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        compressors["br"] = lambda data: brotli.compress(data, quality=11)
+    for encoding, suffix in ENCODINGS:
+        if encoding not in compressors:
+            continue
+        if os.path.exists(path + suffix) and os.path.getmtime(
+            path + suffix
+        ) >= os.path.getmtime(path):
+            continue
+        with open(path + suffix + ".tmp", "wb") as f:
+            f.write(compressors[encoding](data))
+        os.replace(path + suffix + ".tmp", path + suffix)
+
+
+def register_assets(app: Flask):
+    """
+    Serves the static files of an application under fingerprinted names.
+
+    url_for("static", ...) returns the fingerprinted name, which browsers may
+    cache forever, since a changed file gets a new name. Precompressed
+    variants are served to browsers accepting them.
+
+    Args:
+        app (Flask): The application.
+    """
+    _fingerprints.update(build_assets(app.static_folder))
+    _originals.update({value: key for key, value in _fingerprints.items()})
+    app.url_defaults(_fingerprint_url)
+    app.view_functions["static"] = _send_static
+
+
+def _fingerprint_url(endpoint: str, values: dict):
+    """
+    Replaces the file name of static URLs by its fingerprinted name.
+
+    Args:
+        endpoint (str): The endpoint of the URL.
+        values (dict): The values of the URL.
+    """
+    if endpoint == "static" and values.get("filename") in _fingerprints:
+        values["filename"] = _fingerprints[values["filename"]]
+
+
+def _send_static(filename: str):
+    """
+    Sends a static file, precompressed if the browser accepts it.
+
+    Args:
+        filename (str): The requested, possibly fingerprinted, file name.
+
+    Returns:
+        Response: The file.
+    """
+    original = _originals.get(filename, None)
+    immutable = original is not None
+    if original is None:
+        # Pages cached before an update still refer to old fingerprints
+        match = FINGERPRINTED.match(filename)
+        original = match["name"] + match["ext"] if match else filename
+    path = safe_join(current_app.static_folder, original)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    for encoding, suffix in ENCODINGS:
+        if request.accept_encodings[encoding] and os.path.isfile(path + suffix):
+            response = send_file(
+                path + suffix,
+                mimetype=mimetypes.guess_type(original)[0],
+                conditional=True,
+            )
+            response.headers["Content-Encoding"] = encoding
+            break
+    else:
+        response = send_file(path, conditional=True)
+    response.vary.add("Accept-Encoding")
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    return response
+
+
+if __name__ == "__main__":
+    # Builds the compressed variants ahead of time, e.g. in the image
+    for name in build_assets(sys.argv[1] if len(sys.argv) > 1 else "static"):
+        print(name)
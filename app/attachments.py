@@ -0,0 +1,169 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import base64
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+from typing import AsyncIterator
+from werkzeug.datastructures import FileStorage
+
+from app import app
+
+# Size of the chunks uploads are copied and encoded in; a multiple of 3, so
+# the base64 of the chunks can be joined
+CHUNK_SIZE = 3 * 256 * 1024
+
+# Size of the slices request bodies are written in, so the transport only
+# buffers one slice of a large attachment per request
+SEND_CHUNK_SIZE = 64 * 1024
+
+
+def get_attachments_dir() -> str:
+    """
+    Returns the directory of the stored attachments, creating it if necessary.
+
+    Returns:
+        str: The path of the directory.
+    """
+    path = os.path.join(app.config.get("DATA_DIR", "data"), "attachments")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def store_attachment(file: FileStorage) -> dict[str, str | int]:
+    """
+    Streams an uploaded file to disk, named after the SHA-256 of its content.
+
+    The base64 encoding the API expects is written next to it, so it is only
+    computed once, however often the file is uploaded or sent.
+
+    Args:
+        file (FileStorage): The uploaded file.
+
+    Returns:
+        dict: The SHA-256, file name, content type and size of the attachment.
+    """
+    directory = get_attachments_dir()
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as raw, open(
+        raw.name + ".b64", "wb"
+    ) as encoded:
+        try:
+            while chunk := file.stream.read(CHUNK_SIZE):
+                # Uploads may arrive in smaller pieces than requested
+                while len(chunk) % 3 and (more := file.stream.read(3 - len(chunk) % 3)):
+                    chunk += more
+                digest.update(chunk)
+                size += len(chunk)
+                raw.write(chunk)
+                encoded.write(base64.b64encode(chunk))
+        except BaseException:
+            os.remove(raw.name + ".b64")
+            os.remove(raw.name)
+            raise
+
+    sha256 = digest.hexdigest()
+    path = os.path.join(directory, sha256)
+    os.replace(raw.name, path)
+    os.replace(raw.name + ".b64", path + ".b64")
+    return {
+        "sha256": sha256,
+        # Semicolons and commas would end the file name in the data URI
+        "filename": os.path.basename(file.filename or sha256)
+        .replace(";", "_")
+        .replace(",", "_"),
+        "content_type": file.mimetype or "application/octet-stream",
+        "size": size,
+    }
+
+
+def encode_attachments(
+    attachments: list[dict[str, str | int]],
+) -> list[bytes | mmap.mmap]:
+    """
+    Returns the base64_attachments field of a send request as JSON, in parts.
+
+    The stored base64 encodings are memory-mapped instead of read, so every
+    request of a broadcast streams the same pages of the page cache, and
+    nothing is kept once the broadcast is sent.
+
+    Args:
+        attachments (list): The attachments returned by store_attachment.
+
+    Raises:
+        OSError: If an attachment is not stored.
+
+    Returns:
+        list: The parts of the JSON list of data URIs, to be written one after another.
+    """
+    parts = []
+    for attachment in attachments:
+        # The opening quote of the data URI, without the closing one
+        header = json.dumps(
+            "data:%s;filename=%s;base64,"
+            % (attachment["content_type"], attachment["filename"])
+        )[:-1]
+        parts.append((", " if parts else "[") + header)
+        parts.append(_map_encoded(attachment["sha256"]))
+        parts.append('"')
+    parts.append("]" if parts else "[]")
+    return [part.encode() if isinstance(part, str) else part for part in parts]
+
+
+def _map_encoded(sha256: str) -> mmap.mmap | bytes:
+    """
+    Maps the base64 encoding of a stored attachment into memory.
+
+    Args:
+        sha256 (str): The SHA-256 of the attachment.
+
+    Raises:
+        OSError: If the attachment is not stored.
+
+    Returns:
+        mmap or bytes: The read-only mapping, or empty bytes for an empty file.
+    """
+    with open(os.path.join(get_attachments_dir(), sha256 + ".b64"), "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+async def stream_parts(parts: list[bytes | mmap.mmap]) -> AsyncIterator[memoryview]:
+    """
+    Yields the parts of a request body in slices of SEND_CHUNK_SIZE bytes.
+
+    The slices are views of the parts, so they are not copied.
+
+    Args:
+        parts (list): The parts of the body.
+
+    Yields:
+        memoryview: The next slice of the body.
+    """
+    for part in parts:
+        view = memoryview(part)
+        for offset in range(0, len(view), SEND_CHUNK_SIZE):
+            yield view[offset : offset + SEND_CHUNK_SIZE]
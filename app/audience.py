@@ -0,0 +1,200 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import re
+from flask_babel import gettext
+
+# Selectors combine property comparisons with AND, OR, NOT and parentheses,
+# e.g. 'lang=de AND (team=ops OR team="on call") AND NOT retired'.
+TOKEN = re.compile(r'\s*(?:(\(|\)|!=|=)|"((?:[^"\\]|\\.)*)"|([^\s()=!"]+))')
+
+
+def index_value(value) -> str | None:
+    """
+    Converts a property value into its key in the property index.
+
+    Args:
+        value: The value of a contact property.
+
+    Returns:
+        str or None: The key of the value, or None if the value is not a scalar.
+    """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (str, int, float)):
+        return str(value)
+    return None
+
+
+def build_property_index(
+    contacts: dict[str, dict],
+) -> dict[str, dict[str, set[str]]]:
+    """
+    Builds the inverted index of contact properties.
+
+    Args:
+        contacts (dict): The contacts, keyed by name.
+
+    Returns:
+        dict: The names of the contacts per property and value.
+    """
+    properties: dict[str, dict[str, set[str]]] = {}
+    for name, contact in contacts.items():
+        for prop, value in contact.items():
+            key = index_value(value)
+            if key is not None:
+                properties.setdefault(prop, {}).setdefault(key, set()).add(name)
+    return properties
+
+
+def select_contacts(selector: str, snapshot: dict) -> set[str]:
+    """
+    Resolves a selector expression to the names of the matching contacts.
+
+    Args:
+        selector (str): The selector, e.g. "lang=de AND team=ops".
+        snapshot (dict): The snapshot of contacts and their property index.
+
+    Raises:
+        ValueError: If the selector is invalid.
+
+    Returns:
+        set: The names of the matching contacts.
+    """
+    tokens = _tokenize(selector)
+    if not tokens:
+        return set()
+    names, position = _parse_or(tokens, 0, snapshot)
+    if position != len(tokens):
+        raise ValueError(
+            gettext("Unexpected %(token)s in selector") % {"token": tokens[position][1]}
+        )
+    return names
+
+
+def _tokenize(selector: str) -> list[tuple[str, str]]:
+    """
+    Splits a selector into operators, quoted values and words.
+
+    Args:
+        selector (str): The selector.
+
+    Raises:
+        ValueError: If the selector contains an invalid character.
+
+    Returns:
+        list: Tuples of token type ("op", "value" or "word") and text.
+    """
+    tokens = []
+    position = 0
+    selector = selector.strip()
+    while position < len(selector):
+        match = TOKEN.match(selector, position)
+        if match is None or match.end() == position:
+            raise ValueError(
+                gettext("Invalid selector near %(text)s")
+                % {"text": selector[position:]}
+            )
+        operator, quoted, word = match.groups()
+        if operator is not None:
+            tokens.append(("op", operator))
+        elif quoted is not None:
+            tokens.append(("value", re.sub(r"\\(.)", r"\1", quoted)))
+        else:
+            tokens.append(("word", word))
+        position = match.end()
+    return tokens
+
+
+def _keyword(tokens: list, position: int, keyword: str) -> bool:
+    """
+    Checks whether the token at a position is the given keyword.
+    """
+    return (
+        position < len(tokens)
+        and tokens[position][0] == "word"
+        and tokens[position][1].upper() == keyword
+    )
+
+
+def _parse_or(tokens: list, position: int, snapshot: dict) -> tuple[set[str], int]:
+    """
+    Parses alternatives joined by OR.
+    """
+    names, position = _parse_and(tokens, position, snapshot)
+    while _keyword(tokens, position, "OR"):
+        other, position = _parse_and(tokens, position + 1, snapshot)
+        names = names | other
+    return names, position
+
+
+def _parse_and(tokens: list, position: int, snapshot: dict) -> tuple[set[str], int]:
+    """
+    Parses conditions joined by AND.
+    """
+    names, position = _parse_not(tokens, position, snapshot)
+    while _keyword(tokens, position, "AND"):
+        other, position = _parse_not(tokens, position + 1, snapshot)
+        names = names & other
+    return names, position
+
+
+def _parse_not(tokens: list, position: int, snapshot: dict) -> tuple[set[str], int]:
+    """
+    Parses a negated condition, a parenthesized selector or a comparison.
+    """
+    if _keyword(tokens, position, "NOT"):
+        names, position = _parse_not(tokens, position + 1, snapshot)
+        return set(snapshot["contacts"]) - names, position
+    if position < len(tokens) and tokens[position] == ("op", "("):
+        names, position = _parse_or(tokens, position + 1, snapshot)
+        if position >= len(tokens) or tokens[position] != ("op", ")"):
+            raise ValueError(gettext("Missing ) in selector"))
+        return names, position + 1
+    return _parse_comparison(tokens, position, snapshot)
+
+
+def _parse_comparison(
+    tokens: list, position: int, snapshot: dict
+) -> tuple[set[str], int]:
+    """
+    Parses a property, optionally compared with = or != to a value.
+    """
+    if position >= len(tokens) or tokens[position][0] == "op":
+        raise ValueError(gettext("Expected a property in selector"))
+    prop = tokens[position][1]
+    values = snapshot["properties"].get(prop, {})
+    position += 1
+
+    if position < len(tokens) and tokens[position] in (("op", "="), ("op", "!=")):
+        operator = tokens[position][1]
+        if position + 1 >= len(tokens) or tokens[position + 1][0] == "op":
+            raise ValueError(
+                gettext("Expected a value after %(property)s%(operator)s in selector")
+                % {"property": prop, "operator": operator}
+            )
+        names = values.get(tokens[position + 1][1], set())
+        if operator == "!=":
+            names = set(snapshot["contacts"]) - names
+        return names, position + 2
+
+    # A property without a value selects every contact that has it
+    return set().union(*values.values()), position
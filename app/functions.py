@@ -18,20 +18,78 @@ along with Signal Broadcaster. If not, see
 <https://www.gnu.org/licenses/>.
 """
 
+import asyncio
+import hashlib
 import json
 import requests
-from flask import flash, redirect, render_template_string, request, session, url_for
+import time
+from bisect import bisect_left, bisect_right
+from concurrent.futures import FIRST_COMPLETED, wait
+from datetime import datetime, timedelta, timezone
+from flask import flash, g, redirect, request, session, url_for
 from flask_babel import gettext
-from functools import wraps
+from functools import lru_cache, wraps
+from jinja2 import Template, TemplateError, meta
 from logging import getLogger
+from threading import Event, Lock, Thread
+from typing import Callable
 
 from app import app
-from variables import contacts, groups, users
+from attachments import encode_attachments, store_attachment, stream_parts
+from audience import index_value, select_contacts
+from jobs import (
+    add_job_results,
+    claim_job,
+    create_job,
+    fill_outbox,
+    finish_job,
+    get_job,
+    get_next_scheduled_time,
+    get_pending_messages,
+    mark_sending,
+    pause_job,
+    pop_finished_jobs,
+    requeue_running_jobs,
+)
+from metrics import get_average, increment, observe
+from ratelimit import (
+    acquire,
+    backoff,
+    deposit_retry_budget,
+    get_rate,
+    parse_retry_after,
+    report_rate_limited,
+    report_success,
+    withdraw_retry_budget,
+)
+from shared import get_shared, update_shared
+from upstream import (
+    CircuitOpenError,
+    api_get,
+    api_post,
+    is_api_available,
+    run_api_coroutine,
+    wait_for_api,
+    wait_for_api_async,
+)
+from variables import get_snapshot, hash_token, normalize_phone
 
 logger = getLogger(__name__)
 
-# Initialize a session for HTTP requests
-session_requests = requests.Session()
+# Limits the number of requests in flight per sender number; only used on
+# the event loop of the API client
+_sender_limits: dict[str, asyncio.Semaphore] = {}
+
+# Wakes up the job workers when a new job is queued
+_job_wakeup = Event()
+
+# Accounts linked to the API, shared by all worker processes
+ACCOUNTS_KEY = "accounts"
+ACCOUNTS_DEFAULT = {"accounts": [], "fetched": 0.0, "generation": 0}
+
+# The refresh of the accounts running in this process
+_accounts_refresh: dict = {"future": None}
+_accounts_lock = Lock()
 
 
 def check_user(username: str, password: str) -> bool:
@@ -45,26 +103,102 @@ def check_user(username: str, password: str) -> bool:
     Returns:
         bool: True if the credentials are valid, False otherwise.
     """
-    for user in users:
+    for user in get_snapshot()["users"]:
         if user["username"] == username and user["password"] == password:
             return True
     return False
 
 
-def get_accounts() -> list[str]:
+async def get_accounts(max_age: float | None = None) -> list[str]:
     """
     Retrieves a list of accounts from the API.
 
+    The list is cached for ACCOUNTS_CACHE_TTL seconds in the store shared by
+    all worker processes. When the cache is outdated, each process sends
+    only one request to the API and all its callers wait for the result.
+
+    Args:
+        max_age (float, optional): The maximum age of the cached list in seconds. Defaults to ACCOUNTS_CACHE_TTL.
+
     Returns:
-        list: A list of account identifiers, or an empty list if the request fails.
+        list: A list of account identifiers, or the last known list if the request fails.
     """
+    if max_age is None:
+        max_age = app.config.get("ACCOUNTS_CACHE_TTL", 60)
+    cached = get_shared(ACCOUNTS_KEY, ACCOUNTS_DEFAULT)
+    if time.monotonic() - cached["fetched"] < max_age:
+        return cached["accounts"]
+
+    with _accounts_lock:
+        if _accounts_refresh["future"] is None:
+            _accounts_refresh["future"] = run_api_coroutine(
+                _refresh_accounts(cached["generation"])
+            )
+        refresh = _accounts_refresh["future"]
+    return await asyncio.wrap_future(refresh)
+
+
+async def _refresh_accounts(generation: int) -> list[str]:
+    """
+    Requests the list of accounts from the API and caches it.
+
+    Args:
+        generation (int): The generation of the cache when the refresh was started.
+
+    Returns:
+        list: A list of account identifiers, or the last known list if the request fails.
+    """
+
+    def update(cached: dict):
+        # Do not cache a list requested before the cache was invalidated
+        if generation == cached["generation"]:
+            cached.update(accounts=accounts, fetched=time.monotonic())
+
     try:
-        response = session_requests.get("http://api/v1/accounts")
+        response = await api_get("/v1/accounts", "accounts")
         response.raise_for_status()
-        return response.json()
+        accounts = response.json()
+        with _accounts_lock:
+            update_shared(ACCOUNTS_KEY, ACCOUNTS_DEFAULT, update)
+        return accounts
     except requests.RequestException as e:
         logger.error("Failed to get accounts: %s", e)
-        return []
+        return get_shared(ACCOUNTS_KEY, ACCOUNTS_DEFAULT)["accounts"]
+    finally:
+        # Let the next caller start a new refresh, whatever happened to this one
+        with _accounts_lock:
+            _accounts_refresh["future"] = None
+
+
+def invalidate_accounts():
+    """
+    Discards the cached list of accounts, e.g. after a device was unlinked.
+    """
+
+    def update(cached: dict):
+        cached["generation"] += 1
+        cached["fetched"] = 0.0
+
+    update_shared(ACCOUNTS_KEY, ACCOUNTS_DEFAULT, update)
+
+
+async def is_linked(phone: str) -> bool:
+    """
+    Checks whether a phone number is linked to the API.
+
+    Numbers missing from the cached list are checked against a list that is
+    at most ACCOUNTS_RECHECK_INTERVAL seconds old, so a freshly linked device
+    is found quickly.
+
+    Args:
+        phone (str): The phone number to check.
+
+    Returns:
+        bool: True if the phone number is linked, False otherwise.
+    """
+    return phone in await get_accounts() or phone in await get_accounts(
+        app.config.get("ACCOUNTS_RECHECK_INTERVAL", 2)
+    )
 
 
 def get_locale():
@@ -94,30 +228,33 @@ def get_user(username: str, password: str) -> dict[str, str] | None:
     Returns:
         dict or None: User details if credentials are valid, None otherwise.
     """
-    for user in users:
+    for user in get_snapshot()["users"]:
         if user["username"] == username and user["password"] == password:
             return user
     return None
 
 
-def link_device():
-    if session["phone"] in get_accounts():
+async def link_device():
+    if await is_linked(session["phone"]):
         session["device_linked"] = True
         return True
     return False
 
 
-def unlink_device():
+async def unlink_device():
+    response = None
     try:
-        response = session_requests.post(
-            "http://api/v1/unregister/" + session["phone"],
+        response = await api_post(
+            "/v1/unregister/" + session["phone"],
+            "unregister",
             json={"delete_local_data": True},
         )
         response.raise_for_status()
         flash(gettext("Device successfully unlinked."), "success")
     except requests.RequestException as e:
         logger.error("Failed to unregister device: %s", e)
-        flash(response.text if response else str(e), "danger")
+        flash(response.text if response is not None else str(e), "danger")
+    invalidate_accounts()
     logout_user()
 
 
@@ -142,79 +279,941 @@ def logout_user():
     flash(gettext("Successfully logged out!"), "success")
 
 
-def send_message():
-    sender = {
-        "name": session.get("name", ""),
-        "phone": session.get("phone", ""),
-        "lang": session.get("lang", ""),
+def send_message() -> str | None:
+    """
+    Puts the submitted broadcast on the job queue.
+
+    The broadcast may be scheduled for a later time and paced, either at a
+    number of messages per minute or spread over a number of minutes.
+
+    Returns:
+        str or None: The ID of the queued job, or None if the selector or schedule is invalid.
+    """
+    try:
+        payload, scheduled = parse_broadcast_form()
+    except ValueError as e:
+        flash(str(e), "danger")
+        return None
+
+    # Uploads are stored before the job is queued, so the job only refers to
+    # their digests
+    attachments = []
+    for file in request.files.getlist("attachments"):
+        if not file.filename:
+            continue
+        try:
+            attachments.append(store_attachment(file))
+        except OSError as e:
+            logger.error("Failed to store attachment %s: %s", file.filename, e)
+            flash(
+                gettext("Failed to store attachment %(filename)s!")
+                % {"filename": file.filename},
+                "danger",
+            )
+            return None
+
+    payload["attachments"] = attachments
+    job_id, created = create_job(
+        session.get("username", ""), payload, _idempotency_key(), scheduled
+    )
+    if not created:
+        flash(
+            gettext("Broadcast %(job_id)s has already been queued.")
+            % {"job_id": job_id},
+            "info",
+        )
+        return job_id
+    _job_wakeup.set()
+
+    if scheduled is not None:
+        flash(
+            gettext("Broadcast %(job_id)s has been scheduled.") % {"job_id": job_id},
+            "info",
+        )
+        return job_id
+    flash(gettext("Broadcast %(job_id)s has been queued.") % {"job_id": job_id}, "info")
+    return job_id
+
+
+def parse_broadcast_form() -> tuple[dict, float | None]:
+    """
+    Builds the payload of a broadcast job from the submitted form.
+
+    Raises:
+        ValueError: If the selector or schedule is invalid, with a message for the user.
+
+    Returns:
+        tuple: The payload without attachments, and the Unix time the job is scheduled for (or None).
+    """
+    selector = request.form.get("selector", "").strip()
+    if selector:
+        select_contacts(selector, get_snapshot())
+
+    try:
+        scheduled = _parse_schedule(
+            request.form.get("send_at", ""),
+            request.form.get("timezone_offset", ""),
+        )
+        spread = float(request.form.get("spread", "") or 0)
+        rate = float(request.form.get("rate", "") or 0)
+        if spread < 0 or rate < 0:
+            raise ValueError
+    except ValueError:
+        raise ValueError(gettext("Invalid schedule!")) from None
+
+    payload = {
+        "sender": {
+            "name": session.get("name", ""),
+            "phone": session.get("phone", ""),
+            "lang": session.get("lang", ""),
+        },
+        "message_de": request.form.get("message_de", ""),
+        "message_en": request.form.get("message_en", ""),
+        "contacts": request.form.getlist("contacts[]"),
+        "groups": request.form.getlist("groups[]"),
+        "all_contacts": request.form.get("contacts_all", "") == "true",
+        "all_groups": request.form.get("groups_all", "") == "true",
+        # "Select all" refers to the rows matching the search of the table
+        "contacts_query": request.form.get("contacts_query", "").strip(),
+        "groups_query": request.form.get("groups_query", "").strip(),
+        "selector": selector,
+        "pool": get_sender_pool(session.get("username", "")),
+        "spread": spread * 60,
+        "rate": rate / 60,
+        # Messages can use the session like the templates of the pages
+        "session": {
+            key: value
+            for key, value in session.items()
+            if not key.startswith("_") and key != "csrf_token"
+        },
     }
-    message_de = request.form.get("message_de", "")
-    message_en = request.form.get("message_en", "")
-    _contacts = request.form.getlist("contacts[]")
-    _groups = request.form.getlist("groups[]")
+    return payload, scheduled
+
+
+def parse_broadcast_json(data: object, user: dict) -> tuple[dict, float | None]:
+    """
+    Builds the payload of a broadcast job from a broadcast sent to the API.
+
+    A broadcast is an object with the optional fields "messages" (the
+    message by language, "de" and "en"), "contacts" and "groups" (lists of
+    names), "all_contacts" and "all_groups" (booleans), "selector",
+    "send_at" (an ISO 8601 time or Unix time), "spread" (minutes), "rate"
+    (messages per minute) and "idempotency_key".
+
+    Args:
+        data (object): The decoded JSON of the broadcast.
+        user (dict): The user the token belongs to.
+
+    Raises:
+        ValueError: If the broadcast is invalid, with a message for the client.
+
+    Returns:
+        tuple: The payload without attachments, and the Unix time the job is scheduled for (or None).
+    """
+    if not isinstance(data, dict):
+        raise ValueError(gettext("A broadcast must be an object!"))
+
+    def field(name: str, types: type | tuple, default: object) -> object:
+        value = data.get(name, default)
+        if value is None:
+            return default
+        # JSON booleans are ints in Python, but not valid numbers here
+        if not isinstance(value, types) or isinstance(value, bool) != (types is bool):
+            raise ValueError(gettext("Invalid field %(field)s!") % {"field": name})
+        return value
+
+    messages = field("messages", dict, {})
+    if not all(isinstance(messages.get(lang, ""), str) for lang in ("de", "en")):
+        raise ValueError(gettext("Invalid field %(field)s!") % {"field": "messages"})
+    names = {}
+    for name in ("contacts", "groups"):
+        names[name] = field(name, list, [])
+        if not all(isinstance(item, str) for item in names[name]):
+            raise ValueError(gettext("Invalid field %(field)s!") % {"field": name})
+
+    selector = field("selector", str, "").strip()
+    if selector:
+        select_contacts(selector, get_snapshot())
+
+    try:
+        send_at = field("send_at", (str, int, float), "")
+        if isinstance(send_at, str):
+            scheduled = _parse_schedule(send_at, "")
+        else:
+            scheduled = send_at if send_at > time.time() else None
+        spread = field("spread", (int, float), 0)
+        rate = field("rate", (int, float), 0)
+        if spread < 0 or rate < 0:
+            raise ValueError
+    except ValueError:
+        raise ValueError(gettext("Invalid schedule!")) from None
+
+    payload = {
+        "sender": {
+            "name": user.get("name", ""),
+            "phone": user.get("phone", ""),
+            "lang": user.get("lang", ""),
+        },
+        "message_de": messages.get("de", ""),
+        "message_en": messages.get("en", ""),
+        "contacts": names["contacts"],
+        "groups": names["groups"],
+        "all_contacts": field("all_contacts", bool, False),
+        "all_groups": field("all_groups", bool, False),
+        "selector": selector,
+        "pool": get_sender_pool(user.get("username", "")),
+        "spread": spread * 60,
+        "rate": rate / 60,
+        "attachments": [],
+        # The session the user would have if logged in
+        "session": {
+            "logged_in": True,
+            "username": user.get("username", ""),
+            "name": user.get("name", ""),
+            "phone": user.get("phone", ""),
+            "lang": user.get("lang", ""),
+        },
+    }
+    return payload, scheduled
+
+
+def _parse_schedule(send_at: str, timezone_offset: str) -> float | None:
+    """
+    Converts the submitted send time into a Unix time.
+
+    The browser submits the local time without time zone, and the script
+    adds the offset of the browser to UTC in minutes. Without it, the time
+    zone of the server is assumed.
+
+    Args:
+        send_at (str): The time, e.g. "2024-12-24T18:00".
+        timezone_offset (str): The result of Date.getTimezoneOffset() in the browser.
+
+    Raises:
+        ValueError: If the time or offset is invalid.
+
+    Returns:
+        float or None: The Unix time, or None if the broadcast is to be sent right away.
+    """
+    if not send_at:
+        return None
+    when = datetime.fromisoformat(send_at)
+    if timezone_offset:
+        when = when.replace(tzinfo=timezone.utc) + timedelta(
+            minutes=int(timezone_offset)
+        )
+    scheduled = when.timestamp()
+    return scheduled if scheduled > time.time() else None
+
+
+def get_sender_pool(username: str) -> list[str]:
+    """
+    Returns the sender numbers a user may spread broadcasts across.
+
+    The pool is the phone number of the user plus the numbers listed under
+    "senders" in users.yaml.
+
+    Args:
+        username (str): The name of the user.
+
+    Returns:
+        list: The phone numbers, the number of the user first.
+    """
+    for user in get_snapshot()["users"]:
+        if user["username"] == username:
+            pool = [user.get("phone", "")] + list(user.get("senders", None) or [])
+            return list(dict.fromkeys(phone for phone in pool if phone))
+    return []
+
+
+def _get_senders(sender: dict[str, str], pool: list[str]) -> list[dict[str, str]]:
+    """
+    Returns the senders of a broadcast, one for every linked number of the pool.
+
+    Numbers of the pool that are not linked to the API are left out. If none
+    is linked, the broadcast is sent from the number of the user alone.
+
+    Args:
+        sender (dict): Information about the user sending the broadcast.
+        pool (list): The sender numbers the user may use.
+
+    Returns:
+        list: Information about the senders, differing in their phone number.
+    """
+    if len(pool) > 1:
+        accounts = run_api_coroutine(get_accounts()).result()
+        pool = [phone for phone in pool if phone in accounts]
+    if not pool:
+        pool = [sender["phone"]]
+    return [dict(sender, phone=phone) for phone in pool]
+
+
+def _idempotency_key() -> str:
+    """
+    Derives the idempotency key of the submitted broadcast form.
+
+    The form carries a submission ID that is generated whenever it is
+    rendered, so double clicks and resubmits of the same form share a key,
+    while sending the same message again from a new form does not.
+
+    Returns:
+        str: The hex digest of the submitted form fields.
+    """
+    digest = hashlib.sha256()
+    for key in sorted(request.form):
+        if key == "csrf_token":
+            continue
+        for value in request.form.getlist(key):
+            digest.update(("%s=%s\0" % (key, value)).encode())
+    return digest.hexdigest()
+
+
+def start_job_workers():
+    """
+    Starts the background threads that drain the job queue.
+
+    Jobs that were running when the application stopped are queued again.
+    """
+    requeue_running_jobs()
+    for i in range(app.config.get("JOB_WORKERS", 2)):
+        Thread(target=_job_worker, name="job-%d" % i, daemon=True).start()
+
+
+def wake_job_workers():
+    """
+    Makes the job workers look at the queue right away.
+    """
+    _job_wakeup.set()
+
+
+def _job_worker():
+    """
+    Takes jobs off the queue and sends them, forever.
+    """
+    while True:
+        # Leave the jobs on the queue while the API is down
+        if not is_api_available():
+            wait_for_api(app.config.get("JOB_POLL_INTERVAL", 5))
+            continue
+        try:
+            job = claim_job()
+        except Exception as e:
+            logger.error("Failed to claim job: %s", e)
+            job = None
+        if job is None:
+            # Take over the jobs of worker processes that died
+            try:
+                requeue_running_jobs()
+            except Exception as e:
+                logger.error("Failed to requeue jobs: %s", e)
+            timeout = app.config.get("JOB_POLL_INTERVAL", 5)
+            # Wake up in time for the next scheduled job
+            scheduled = get_next_scheduled_time()
+            if scheduled is not None:
+                timeout = min(timeout, max(scheduled - time.time(), 0.1))
+            _job_wakeup.wait(timeout)
+            _job_wakeup.clear()
+            continue
+        started = time.perf_counter()
+        try:
+            with app.app_context():
+                count, paused = _process_job(job)
+            if paused:
+                continue
+            finish_job(job["id"])
+        except Exception as e:
+            logger.exception("Job %s failed: %s", job["id"], e)
+            finish_job(job["id"], "failed")
+            continue
+        elapsed = time.perf_counter() - started
+        observe("signal_broadcaster_broadcast_seconds", elapsed)
+        if count and elapsed > 0:
+            observe(
+                "signal_broadcaster_broadcast_recipients_per_second", count / elapsed
+            )
+
+
+def _process_job(job: dict):
+    """
+    Sends a broadcast job and keeps its counters up to date.
 
-    messages = []
+    On first run, the audience is resolved and stored in the outbox. A job
+    resumed after a crash only sends to the recipients still pending there.
 
-    # Send messages to group members
-    for _group in _groups:
-        group = groups.get(_group, None)
+    A paced job sends only the recipients due within PACE_INTERVAL seconds
+    per run and is then paused until the next release is due, so it does
+    not occupy the worker in between.
+
+    Args:
+        job (dict): The claimed job.
+
+    Returns:
+        tuple: The number of recipients handled in this run, and whether the job was paused.
+    """
+    started = time.time()
+    payload = job["payload"]
+    senders = _get_senders(payload["sender"], payload.get("pool", []))
+    snapshot = get_snapshot()
+
+    if not job["prepared"]:
+        fill_outbox(job["id"], build_outbox_rows(payload, snapshot))
+
+    messages = _get_templates(payload)
+
+    # A broadcast spread over a time span is paced to finish at its end; with
+    # a rate as well, the lower of both applies
+    rate = payload.get("rate", 0)
+    if payload.get("spread", 0):
+        spread_rate = get_job(job["id"])["total"] / payload["spread"]
+        if spread_rate:
+            rate = min(rate, spread_rate) if rate else spread_rate
+
+    release = -1
+    if rate:
+        release = max(int(rate * app.config.get("PACE_INTERVAL", 1)), 1)
+    # One more row tells whether recipients are left for a later release
+    pending = get_pending_messages(job["id"], release + 1 if rate else -1)
+    paused = bool(rate) and len(pending) > release
+    if paused:
+        pending = pending[:release]
+    tasks = []
+    for row in pending:
+        group = None
+        if row["group_name"] is not None:
+            group = snapshot["groups"].get(
+                row["group_name"], {"name": row["group_name"]}
+            )
+        tasks.append((messages[row["message"]], row["contact"], group))
+
+    def dispatch(indices: list[int]) -> bool:
+        # Checked whenever more messages are handed to the API client, so a
+        # cancelled job stops after the messages in flight
+        if get_job(job["id"])["status"] == "cancelled":
+            logger.info("Job %s was cancelled", job["id"])
+            return False
+        mark_sending(job["id"], [pending[index]["phone"] for index in indices])
+        return True
+
+    # Results are written in batches to keep the number of transactions low
+    results = []
+    flushed = time.monotonic()
+
+    # The attachments are encoded once and sent with every request
+    attachments = None
+    if payload.get("attachments", []):
+        attachments = encode_attachments(payload["attachments"])
+
+    context = get_template_context(payload.get("session", {}))
+    for index, (ok, status, data) in _dispatch_messages(
+        senders, tasks, dispatch, attachments, context
+    ):
+        results.append((pending[index]["phone"], ok, status, data))
+        increment(
+            "signal_broadcaster_messages_total",
+            result="sent" if ok else "failed",
+            status=status,
+        )
+        if len(results) >= 100 or time.monotonic() - flushed >= 1:
+            add_job_results(job["id"], results)
+            results = []
+            flushed = time.monotonic()
+    if results:
+        add_job_results(job["id"], results)
+    if paused:
+        pause_job(job["id"], started + release / rate)
+    return len(tasks), paused
+
+
+def build_outbox_rows(
+    payload: dict, snapshot: dict
+) -> list[tuple[str, str, str, dict, str | None]]:
+    """
+    Resolves the audience of a broadcast job into the rows of its outbox.
+
+    Args:
+        payload (dict): The payload of the job.
+        snapshot (dict): The contacts snapshot to resolve the audience with.
+
+    Returns:
+        list: Tuples of phone, name, message key ("de", "en" or "mixed"), contact and group name (or None).
+    """
+    # The recipient tables only load the visible rows, so "select all" is
+    # submitted as a flag instead of a list of names
+    group_names = payload.get("groups", [])
+    if payload.get("all_groups", False):
+        group_names = match_names(snapshot, "groups", payload.get("groups_query", ""))
+    contact_names = payload.get("contacts", [])
+    if payload.get("all_contacts", False):
+        contact_names = match_names(
+            snapshot, "contacts", payload.get("contacts_query", "")
+        )
+    if payload.get("selector", ""):
+        contact_names = contact_names + sorted(
+            select_contacts(payload["selector"], snapshot)
+        )
+
+    rows = []
+    for phone, (contact, group) in resolve_audience(group_names, contact_names).items():
+        message = contact.get("lang", None)
+        if message not in ("de", "en"):
+            message = "mixed"
+        rows.append(
+            (
+                phone,
+                contact.get("name", ""),
+                message,
+                contact,
+                group.get("name", "") if group is not None else None,
+            )
+        )
+    return rows
+
+
+def _get_templates(payload: dict) -> dict[str, str]:
+    """
+    Returns the message templates of a broadcast job by message key.
+
+    Args:
+        payload (dict): The payload of the job.
+
+    Returns:
+        dict: The templates for German, English and mixed recipients.
+    """
+    messages = {
+        "de": payload.get("message_de", ""),
+        "en": payload.get("message_en", ""),
+    }
+    messages["mixed"] = messages["de"] + "\n\n" + messages["en"]
+    return messages
+
+
+def plan_broadcast(payload: dict) -> dict:
+    """
+    Estimates what sending a broadcast would take, without sending anything.
+
+    The audience is resolved like for a job, and the templates are rendered
+    for a sample of PLAN_SAMPLE_SIZE recipients. The number of requests
+    assumes the recipients are spread evenly across the sender numbers. The
+    duration uses the current rate of each sender number and the average
+    latency of the send requests so far.
+
+    Args:
+        payload (dict): The payload of the broadcast, as built by parse_broadcast_form.
+
+    Returns:
+        dict: The numbers of recipients, messages per language, requests and failed samples, sample messages, and the estimated duration in seconds.
+    """
+    started = time.perf_counter()
+    snapshot = get_snapshot()
+    senders = _get_senders(payload["sender"], payload.get("pool", []))
+    templates = _get_templates(payload)
+    rows = build_outbox_rows(payload, snapshot)
+
+    messages = dict.fromkeys(templates, 0)
+    for row in rows:
+        messages[row[2]] += 1
+
+    # Requests per sender: personalized templates are counted with one
+    # request per recipient, the others with one per batch
+    batch_size = max(app.config.get("SEND_BATCH_SIZE", 50), 1)
+    requests_by_sender = [0] * len(senders)
+    for key, count in messages.items():
+        for index in range(len(senders)):
+            share = count // len(senders) + (index < count % len(senders))
+            if _uses_recipient(templates[key]):
+                requests_by_sender[index] += share
+            else:
+                requests_by_sender[index] += -(-share // batch_size)
+
+    samples = []
+    failed = 0
+    context = get_template_context(payload.get("session", {}))
+    sample_size = app.config.get("PLAN_SAMPLE_SIZE", 20)
+    for row in rows[:: max(len(rows) // sample_size, 1)][:sample_size]:
+        phone, name, key, contact, group_name = row
+        group = None
+        if group_name is not None:
+            group = snapshot["groups"].get(group_name, {"name": group_name})
+        ok, _, message = _render_message(
+            senders[_pick_sender(senders, phone)],
+            templates[key],
+            contact,
+            group,
+            context,
+        )
+        failed += not ok
+        if len(samples) < 3:
+            samples.append({"name": name, "ok": ok, "message": message})
+
+    latency = get_average("signal_broadcaster_api_request_seconds", endpoint="send")
+    duration = 0.0
+    for sender, requests_count in zip(senders, requests_by_sender):
+        by_rate = max(requests_count - app.config.get("SEND_BURST", 10), 0) / get_rate(
+            sender["phone"]
+        )
+        by_latency = (
+            requests_count
+            * (latency or 0)
+            / max(app.config.get("SEND_CONCURRENCY", 8), 1)
+        )
+        duration = max(duration, by_rate, by_latency)
+    # Pacing of the broadcast itself
+    if payload.get("rate", 0):
+        duration = max(duration, len(rows) / payload["rate"])
+    if payload.get("spread", 0):
+        duration = max(duration, payload["spread"])
+
+    return {
+        "recipients": len(rows),
+        "messages": messages,
+        "senders": len(senders),
+        "requests": sum(requests_by_sender),
+        "sampled": min(len(rows), sample_size),
+        "failed": failed,
+        "samples": samples,
+        "latency": latency,
+        "duration": duration,
+        "elapsed": time.perf_counter() - started,
+    }
+
+
+def flash_finished_jobs():
+    """
+    Flashes a summary of every finished broadcast of the current user once.
+    """
+    for job in pop_finished_jobs(session.get("username", "")):
+        if job["status"] == "cancelled":
+            message = gettext(
+                "Broadcast %(job_id)s was cancelled: %(sent)d of %(total)d messages"
+                " sent, %(failed)d failed."
+            )
+        else:
+            message = gettext(
+                "Broadcast %(job_id)s finished: %(sent)d of %(total)d messages sent,"
+                " %(failed)d failed."
+            )
+        flash(
+            message
+            % {
+                "job_id": job["id"],
+                "sent": job["sent"],
+                "total": job["total"],
+                "failed": job["failed"],
+            },
+            "success" if job["status"] == "done" and not job["failed"] else "danger",
+        )
+
+
+def resolve_audience(
+    group_names: list[str], contact_names: list[str]
+) -> dict[str, tuple[dict, dict | None]]:
+    """
+    Expands the selected groups and contacts into unique recipients.
+
+    Recipients are keyed by their normalized phone number, so a contact that
+    is selected several times receives the message only once. The first
+    selection determines the group available to the message template.
+
+    Args:
+        group_names (list): The names of the selected groups.
+        contact_names (list): The names of the selected contacts.
+
+    Returns:
+        dict: The contact and group (or None) of every recipient, keyed by phone number.
+    """
+    snapshot = get_snapshot()
+    audience = {}
+
+    def add(contact: dict | None, group: dict | None):
+        if contact is None:
+            return
+        phone = normalize_phone(contact.get("phone", ""))
+        if phone and phone not in audience:
+            audience[phone] = (contact, group)
+
+    for name in group_names:
+        group = snapshot["groups"].get(name, None)
         if group is None:
             continue
         for member in group.get("members", []):
-            if member is None:
+            add(member, group)
+
+    for name in contact_names:
+        add(snapshot["contacts"].get(name, None), None)
+
+    return audience
+
+
+def search_recipients(
+    kind: str,
+    query: str = "",
+    match: str = "substring",
+    filters: dict[str, str] | None = None,
+    cursor: str = "",
+    limit: int = 50,
+) -> tuple[list[dict], str | None]:
+    """
+    Searches contacts or groups by name, one page at a time.
+
+    Names are searched case-insensitively in the sorted index of the current
+    snapshot. Contacts are filtered with the property index. The cursor is the
+    name of the last item of the previous page.
+
+    Args:
+        kind (str): Either "contacts" or "groups".
+        query (str, optional): The text to search for. Defaults to "".
+        match (str, optional): Either "prefix" or "substring". Defaults to "substring".
+        filters (dict, optional): Properties the items must have, e.g. {"lang": "de"}. Defaults to None.
+        cursor (str, optional): The name of the last item of the previous page. Defaults to "".
+        limit (int, optional): The maximum number of items. Defaults to 50.
+
+    Returns:
+        tuple: The items of the page and the cursor of the next page, or None on the last page.
+    """
+    snapshot = get_snapshot()
+    items = snapshot[kind]
+    index = snapshot["index"][kind]
+    query = query.casefold()
+    filters = filters or {}
+
+    # Contacts are filtered by intersecting the name sets of the property index
+    allowed = None
+    if kind == "contacts" and filters:
+        sets = [
+            snapshot["properties"].get(prop, {}).get(index_value(value), set())
+            for prop, value in filters.items()
+        ]
+        allowed = set.intersection(*sets)
+        filters = {}
+
+    start = bisect_right(index, (cursor.casefold(), cursor)) if cursor else 0
+    if query and match == "prefix":
+        start = max(start, bisect_left(index, (query,)))
+
+    page = []
+    for position in range(start, len(index)):
+        key, name = index[position]
+        if query:
+            if match == "prefix" and not key.startswith(query):
+                break
+            if match != "prefix" and query not in key:
                 continue
-            match member.get("lang", None):
-                case "de":
-                    messages.append(_send_message(sender, message_de, member, group))
-                case "en":
-                    messages.append(_send_message(sender, message_en, member, group))
-                case _:
-                    messages.append(
-                        _send_message(
-                            sender, message_de + "\n\n" + message_en, member, group
-                        )
-                    )
-
-    # Send messages to individual contacts
-    for _contact in _contacts:
-        contact = contacts.get(_contact, None)
-        if contact is None:
+        if allowed is not None and name not in allowed:
             continue
-        match contact.get("lang", None):
-            case "de":
-                messages.append(_send_message(sender, message_de, contact))
-            case "en":
-                messages.append(_send_message(sender, message_en, contact))
-            case _:
-                messages.append(
-                    _send_message(sender, message_de + "\n\n" + message_en, contact)
+        item = items[name]
+        if any(str(item.get(prop, "")) != value for prop, value in filters.items()):
+            continue
+        if len(page) == limit:
+            return page, page[-1]["name"]
+        page.append(_describe_recipient(kind, item))
+
+    return page, None
+
+
+def match_names(snapshot: dict, kind: str, query: str = "") -> list[str]:
+    """
+    Returns the names of all contacts or groups matching a search.
+
+    The names are matched like the search field of the recipient tables
+    does, so "select all" applies to exactly the rows shown.
+
+    Args:
+        snapshot (dict): The contacts snapshot.
+        kind (str): Either "contacts" or "groups".
+        query (str, optional): The text to search for. Defaults to "", matching all.
+
+    Returns:
+        list: The matching names.
+    """
+    if not query:
+        return list(snapshot[kind])
+    query = query.casefold()
+    return [name for key, name in snapshot["index"][kind] if query in key]
+
+
+def _describe_recipient(kind: str, item: dict) -> dict:
+    """
+    Converts a contact or group into the data shown in the recipient tables.
+
+    Args:
+        kind (str): Either "contacts" or "groups".
+        item (dict): The contact or group.
+
+    Returns:
+        dict: The name, the columns and the other properties of the item.
+    """
+    if kind == "groups":
+        members = [member for member in item.get("members", []) if member]
+        columns = {
+            "members": [member["name"] for member in members[:20]],
+            "size": len(members),
+        }
+        hidden = ("name", "members")
+    else:
+        columns = {"lang": item.get("lang", ""), "phone": item.get("phone", "")}
+        hidden = ("name", "lang", "phone")
+    return {
+        "name": item["name"],
+        **columns,
+        "props": {
+            prop: str(value) for prop, value in item.items() if prop not in hidden
+        },
+    }
+
+
+def _dispatch_messages(
+    senders: list[dict[str, str]],
+    tasks: list[tuple[str, dict[str, str], dict[str, str] | None]],
+    on_dispatch: Callable[[list[int]], bool] | None = None,
+    attachments: list | None = None,
+    context: dict | None = None,
+):
+    """
+    Renders all messages and sends them concurrently.
+
+    The templates are rendered in the calling thread, templates which do not
+    use contact or group are only rendered once. Recipients whose
+    rendered messages are identical are sent in one request with up to
+    SEND_BATCH_SIZE recipients. The requests to the API run concurrently on
+    the API client loop, limited to SEND_CONCURRENCY requests per sender
+    number. At most SEND_WINDOW requests are handed to the loop at a time.
+    With several senders, every recipient is sent to by the sender picked by
+    _pick_sender.
+
+    Args:
+        senders (list): Information about the senders, one per sender number.
+        tasks (list): Tuples of message template, contact and group (or None).
+        on_dispatch (Callable, optional): Called with the indices of the tasks before their requests are handed to the loop; if it returns False, no more requests are made. Defaults to None.
+        attachments (list, optional): The attachments of every message, as returned by encode_attachments. Defaults to None.
+        context (dict, optional): The template context, as returned by get_template_context. Defaults to None.
+
+    Yields:
+        tuple: The index of the task and its result tuple, in order of completion.
+    """
+    batches: dict[tuple[int, str], list[int]] = {}
+    rendered: dict[tuple[int, str], tuple[bool, int, str]] = {}
+    for index, (message, contact, group) in enumerate(tasks):
+        sender = _pick_sender(senders, normalize_phone(contact.get("phone", "")))
+        key = (sender, message)
+        if key in rendered:
+            ok, status, message = rendered[key]
+        else:
+            result = _render_message(senders[sender], message, contact, group, context)
+            if not _uses_recipient(message):
+                rendered[key] = result
+            ok, status, message = result
+        if not ok:
+            yield index, (ok, status, message)
+            continue
+        batches.setdefault((sender, message), []).append(index)
+
+    batch_size = max(app.config.get("SEND_BATCH_SIZE", 50), 1)
+    chunks = [
+        (senders[sender], message, indices[i : i + batch_size])
+        for (sender, message), indices in batches.items()
+        for i in range(0, len(indices), batch_size)
+    ]
+
+    # The window is refilled once half of it is done, so on_dispatch is
+    # called for many requests at once
+    window = max(app.config.get("SEND_WINDOW", 64), 1)
+    futures = {}
+    position = 0
+    while position < len(chunks) or futures:
+        if position < len(chunks) and len(futures) <= window // 2:
+            refill = chunks[position : position + window - len(futures)]
+            position += len(refill)
+            if on_dispatch is not None and not on_dispatch(
+                [index for _, _, chunk in refill for index in chunk]
+            ):
+                # Only wait for the requests in flight
+                position = len(chunks)
+                continue
+            for sender, message, chunk in refill:
+                recipients = [
+                    normalize_phone(tasks[index][1].get("phone", "")) for index in chunk
+                ]
+                future = run_api_coroutine(
+                    _post_message(sender, message, recipients, attachments)
                 )
+                futures[future] = chunk
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            result = future.result()
+            for index in futures.pop(future):
+                yield index, result
+
 
-    flash(gettext("Messages sent successfully!"), "info")
-    flash(json.dumps(messages), "success")
+def _pick_sender(senders: list[dict[str, str]], phone: str) -> int:
+    """
+    Picks the sender of a recipient by rendezvous hashing.
+
+    Every recipient is always sent to from the same number, as long as that
+    number stays in the pool. If a number is removed, only its recipients
+    move to other numbers.
 
+    Args:
+        senders (list): Information about the senders.
+        phone (str): The normalized phone number of the recipient.
 
-def _send_message(
+    Returns:
+        int: The index of the sender in the list.
+    """
+    if len(senders) == 1:
+        return 0
+    return max(
+        range(len(senders)),
+        key=lambda index: hashlib.sha256(
+            ("%s\0%s" % (senders[index]["phone"], phone)).encode()
+        ).digest(),
+    )
+
+
+def _sender_limit(phone: str) -> asyncio.Semaphore:
+    """
+    Returns the semaphore limiting the concurrent requests of a sender number.
+
+    Must be called on the API client loop.
+
+    Args:
+        phone (str): The phone number of the sender.
+
+    Returns:
+        asyncio.Semaphore: The semaphore of the sender number.
+    """
+    if phone not in _sender_limits:
+        _sender_limits[phone] = asyncio.Semaphore(app.config.get("SEND_CONCURRENCY", 8))
+    return _sender_limits[phone]
+
+
+def _render_message(
     sender: dict[str, str],
     message: str,
     contact: dict[str, str],
     group: dict[str, str] = None,
-) -> tuple[bool, int, dict | str]:
+    context: dict | None = None,
+) -> tuple[bool, int, str]:
     """
-    Sends a message to a contact or group.
+    Renders the message template for a contact.
 
     Args:
         sender (dict): Information about the sender.
-        message (str): The message content.
+        message (str): The message template.
         contact (dict): The contact to receive the message.
-        group (dict, optional): The group to send the message to. Defaults to None.
+        group (dict, optional): The group the contact was selected by. Defaults to None.
+        context (dict, optional): The template context, as returned by get_template_context. Defaults to None.
 
     Returns:
-        tuple: A tuple containing success status, HTTP status code, and response data or error message.
+        tuple: A tuple containing success status, HTTP status code, and the rendered message or error message.
     """
+    snapshot = get_snapshot()
+    started = time.perf_counter()
     try:
-        message = render_template_string(
-            "{% autoescape false %}" + message + "{% endautoescape %}",
+        message = _compile_message(message)[0].render(
+            context or {},
+            now=datetime.now(),
+            contacts=snapshot["contacts"],
+            groups=snapshot["groups"],
             sender=sender,
             contact=contact,
             group=group,
@@ -222,22 +1221,144 @@ def _send_message(
     except Exception as e:
         logger.error("Error rendering message template: %s", e)
         return False, 500, str(e)
+    finally:
+        observe("signal_broadcaster_render_seconds", time.perf_counter() - started)
+    return True, 200, message
+
+
+def get_template_context(session_data: dict) -> dict:
+    """
+    Builds the variables Flask adds to the templates of a request.
+
+    Messages are rendered by the job workers, outside the request they were
+    submitted in, so the request is recreated with the session of the user.
+    Messages can then use request, session, g, app and the other variables
+    of the context processors, like the templates of the pages.
+
+    Args:
+        session_data (dict): The session of the user who submitted the broadcast.
+
+    Returns:
+        dict: The context variables.
+    """
+    with app.test_request_context():
+        session.update(session_data)
+        # The session is a global proxy, which does not outlive the request
+        context = {"session": session._get_current_object()}
+        app.update_template_context(context)
+    # CSRF tokens need the request and are of no use in messages
+    context.pop("csrf_token", None)
+    context.pop("csrf_meta_tag", None)
+    return context
+
+
+@lru_cache(maxsize=128)
+def _compile_message(message: str) -> tuple[Template, bool]:
+    """
+    Compiles a message template, caching the result.
+
+    Args:
+        message (str): The message template.
+
+    Returns:
+        tuple: The compiled template and whether it uses contact or group.
+    """
+    source = "{% autoescape false %}" + message + "{% endautoescape %}"
+    variables = meta.find_undeclared_variables(app.jinja_env.parse(source))
+    return app.jinja_env.from_string(source), bool(variables & {"contact", "group"})
+
+
+def _uses_recipient(message: str) -> bool:
+    """
+    Checks whether a message template renders differently per recipient.
 
+    Args:
+        message (str): The message template.
+
+    Returns:
+        bool: True if the template uses contact or group, False otherwise or if it does not compile.
+    """
     try:
-        response = session_requests.post(
-            url="http://api/v2/send",
-            headers={"Content-Type": "application/json;charset=UTF-8"},
-            json={
-                "number": sender["phone"],
-                "recipients": [contact.get("phone", "")],
-                "message": message,
-            },
-        )
-        response.raise_for_status()
-        return response.ok, response.status_code, response.json()
-    except requests.RequestException as e:
-        logger.error("Request failed: %s", e)
-        return False, response.status_code if response else 500, str(e)
+        return _compile_message(message)[1]
+    except TemplateError:
+        return False
+
+
+async def _post_message(
+    sender: dict[str, str],
+    message: str,
+    recipients: list[str],
+    attachments: list | None = None,
+) -> tuple[bool, int, dict | str]:
+    """
+    Sends a rendered message to one or more recipients in a single request.
+
+    Requests are paced by the token bucket of the sender number. Connection
+    errors, 429 and 5xx responses are retried up to SEND_RETRIES times with
+    jittered exponential backoff, as long as the retry budget allows it. While
+    the circuit breaker is open, the message is held until the API is back.
+
+    Args:
+        sender (dict): Information about the sender.
+        message (str): The rendered message.
+        recipients (list): The phone numbers of the recipients.
+        attachments (list, optional): The attachments, as returned by encode_attachments. Defaults to None.
+
+    Returns:
+        tuple: A tuple containing success status, HTTP status code, and response data or error message.
+    """
+    phone = sender["phone"]
+    deposit_retry_budget()
+    attempt = 0
+    while True:
+        attempt += 1
+        response = None
+        retry_after = None
+        await acquire(phone)
+        try:
+            async with _sender_limit(phone):
+                # Built only once the request may be sent, so waiting requests
+                # hold no body
+                body = json.dumps(
+                    {"number": phone, "recipients": recipients, "message": message}
+                ).encode()
+                headers = {"Content-Type": "application/json;charset=UTF-8"}
+                if attachments is not None:
+                    # The shared attachments are streamed between the fields
+                    # and the closing brace instead of being copied
+                    parts = [body[:-1] + b', "base64_attachments": ']
+                    parts += attachments + [b"}"]
+                    headers["Content-Length"] = str(sum(len(part) for part in parts))
+                    body = stream_parts(parts)
+                response = await api_post(
+                    "/v2/send", "send", headers=headers, data=body
+                )
+            if response.status_code == 429:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                report_rate_limited(phone, retry_after)
+            response.raise_for_status()
+            report_success(phone)
+            return response.ok, response.status_code, response.json()
+        except CircuitOpenError:
+            # Held messages neither count as attempts nor use the retry budget
+            attempt -= 1
+            await wait_for_api_async()
+            continue
+        except requests.RequestException as e:
+            status = response.status_code if response is not None else 500
+            retryable = response is None or status == 429 or status >= 500
+            if (
+                not retryable
+                or attempt > app.config.get("SEND_RETRIES", 5)
+                or not withdraw_retry_budget()
+            ):
+                logger.error("Request failed: %s", e)
+                return False, status, str(e)
+            delay = backoff(attempt, retry_after)
+            logger.warning(
+                "Request failed (attempt %d), retrying in %.1f s: %s", attempt, delay, e
+            )
+            await asyncio.sleep(delay)
 
 
 # Decorators
@@ -257,7 +1378,7 @@ def link_required(f):
     @wraps(f)
     async def decorated_function(*args, **kwargs):
         if "device_linked" not in session:
-            if session["phone"] in get_accounts():
+            if await is_linked(session["phone"]):
                 session["device_linked"] = True
                 return await f(*args, **kwargs)
             flash(gettext("Please link your device first."), "error")
@@ -286,3 +1407,35 @@ def login_required(f):
         return await f(*args, **kwargs)
 
     return decorated_function
+
+
+def token_required(f):
+    """
+    Decorator to ensure that a request carries the API token of a user.
+
+    The token is sent as "Authorization: Bearer <token>" and must be listed
+    under "tokens" of a user in users.yaml. The user is stored in g.user.
+
+    Args:
+        f (function): The view function to decorate.
+
+    Returns:
+        function: The decorated function that requires a token.
+    """
+
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        user = None
+        if scheme.lower() == "bearer" and token.strip():
+            user = get_snapshot()["tokens"].get(hash_token(token.strip()), None)
+        if user is None:
+            return (
+                {"error": gettext("Invalid or missing token.")},
+                401,
+                {"WWW-Authenticate": "Bearer"},
+            )
+        g.user = user
+        return await f(*args, **kwargs)
+
+    return decorated_function
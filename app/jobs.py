@@ -0,0 +1,780 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import json
+import os
+import sqlite3
+import time
+import uuid
+from logging import getLogger
+from threading import Condition, local
+
+from app import app
+from shared import INSTANCE_ID, is_process_alive
+
+logger = getLogger(__name__)
+
+# Every thread uses its own connection to the job database
+_connections = local()
+
+# Notified whenever jobs of this process make progress
+_job_updates = Condition()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    payload TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    notified INTEGER NOT NULL DEFAULT 0,
+    idempotency_key TEXT,
+    prepared INTEGER NOT NULL DEFAULT 0,
+    batches INTEGER NOT NULL DEFAULT 0,
+    scheduled REAL,
+    delivered INTEGER NOT NULL DEFAULT 0,
+    read INTEGER NOT NULL DEFAULT 0,
+    replied INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    paused_until REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_idempotency_key
+    ON jobs (username, idempotency_key);
+CREATE TABLE IF NOT EXISTS outbox (
+    job_id TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    name TEXT NOT NULL,
+    message TEXT NOT NULL,
+    contact TEXT NOT NULL,
+    group_name TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    status INTEGER,
+    body TEXT,
+    batch INTEGER,
+    sent_at INTEGER,
+    delivered REAL,
+    read REAL,
+    replied REAL,
+    PRIMARY KEY (job_id, phone)
+);
+CREATE INDEX IF NOT EXISTS outbox_state ON outbox (job_id, state);
+CREATE INDEX IF NOT EXISTS outbox_batch ON outbox (job_id, batch);
+CREATE INDEX IF NOT EXISTS outbox_receipts ON outbox (phone, sent_at);
+"""
+
+# Columns added to existing databases, with their definitions
+MIGRATIONS = {
+    "jobs": {
+        "notified": "INTEGER NOT NULL DEFAULT 0",
+        "idempotency_key": "TEXT",
+        "prepared": "INTEGER NOT NULL DEFAULT 0",
+        "batches": "INTEGER NOT NULL DEFAULT 0",
+        "scheduled": "REAL",
+        "delivered": "INTEGER NOT NULL DEFAULT 0",
+        "read": "INTEGER NOT NULL DEFAULT 0",
+        "replied": "INTEGER NOT NULL DEFAULT 0",
+        "owner": "TEXT",
+        "paused_until": "REAL",
+    },
+    "outbox": {
+        "batch": "INTEGER",
+        "sent_at": "INTEGER",
+        "delivered": "REAL",
+        "read": "REAL",
+        "replied": "REAL",
+    },
+}
+
+# Moves the results of databases without outbox into the outbox
+RESULTS_MIGRATION = """
+INSERT OR IGNORE INTO outbox
+    (job_id, phone, name, message, contact, state, status, body)
+    SELECT job_id, phone, name, '', '{}',
+        CASE WHEN ok THEN 'sent' ELSE 'failed' END, status, body
+    FROM results ORDER BY rowid;
+DROP TABLE results;
+"""
+
+# Kinds of receipts, which are also the columns storing them
+RECEIPT_KINDS = ("delivered", "read", "replied")
+
+# Maximum length of a stored API response
+MAX_BODY_LENGTH = 1000
+
+# Stored for messages whose request was interrupted by a crash
+INTERRUPTED = "Interrupted while sending, the message may have been delivered"
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Returns the database connection of the current thread.
+
+    The database and its tables are created on first use.
+
+    Returns:
+        sqlite3.Connection: The connection to the job database.
+    """
+    connection = getattr(_connections, "connection", None)
+    if connection is None:
+        os.makedirs(app.config.get("DATA_DIR", "data"), exist_ok=True)
+        connection = sqlite3.connect(
+            os.path.join(app.config.get("DATA_DIR", "data"), "jobs.sqlite"),
+            timeout=30,
+            isolation_level=None,
+        )
+        connection.row_factory = sqlite3.Row
+        # WAL lets the workers write while the views read, and only syncs to
+        # disk at checkpoints
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        for table, columns in MIGRATIONS.items():
+            existing = {
+                row["name"]
+                for row in connection.execute("PRAGMA table_info(%s)" % table)
+            }
+            if not existing:
+                continue
+            for column, definition in columns.items():
+                if column not in existing:
+                    connection.execute(
+                        "ALTER TABLE %s ADD COLUMN %s %s" % (table, column, definition)
+                    )
+        connection.executescript(SCHEMA)
+        if connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'results'"
+        ).fetchone():
+            connection.executescript("BEGIN;" + RESULTS_MIGRATION + "COMMIT;")
+        _connections.connection = connection
+    return connection
+
+
+def create_job(
+    username: str,
+    payload: dict,
+    idempotency_key: str | None = None,
+    scheduled: float | None = None,
+) -> tuple[str, bool]:
+    """
+    Puts a new broadcast job on the queue.
+
+    A job whose idempotency key was already used by the same user is not
+    queued again, so a resubmitted form sends the broadcast only once.
+
+    Args:
+        username (str): The user who created the job.
+        payload (dict): Everything the workers need to send the broadcast.
+        idempotency_key (str, optional): The key identifying the submission. Defaults to None.
+        scheduled (float, optional): The Unix time before which the job is not started. Defaults to None.
+
+    Returns:
+        tuple: The ID of the job and whether it was newly created.
+    """
+    return create_jobs(username, [(payload, idempotency_key, scheduled)])[0]
+
+
+def create_jobs(
+    username: str, jobs: list[tuple[dict, str | None, float | None]]
+) -> list[tuple[str, bool]]:
+    """
+    Puts several broadcast jobs on the queue in one transaction.
+
+    Args:
+        username (str): The user who created the jobs.
+        jobs (list): Tuples of payload, idempotency key (or None) and scheduled Unix time (or None).
+
+    Returns:
+        list: The ID of every job and whether it was newly created, in order.
+    """
+    now = time.time()
+    created = []
+    connection = get_connection()
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        for payload, idempotency_key, scheduled in jobs:
+            job_id = uuid.uuid4().hex
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO jobs"
+                " (id, username, payload, created, updated, idempotency_key,"
+                " scheduled) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    username,
+                    json.dumps(payload),
+                    now,
+                    now,
+                    idempotency_key,
+                    scheduled,
+                ),
+            )
+            if cursor.rowcount:
+                created.append((job_id, True))
+                continue
+            row = connection.execute(
+                "SELECT id FROM jobs WHERE username = ? AND idempotency_key = ?",
+                (username, idempotency_key),
+            ).fetchone()
+            created.append((row["id"], False))
+    return created
+
+
+def claim_job() -> dict | None:
+    """
+    Takes the oldest due job off the queue and marks it as running.
+
+    Scheduled jobs are due at their scheduled time, paused jobs at the end
+    of their pause, all others right away. Both times are cleared, as the
+    job is no longer waiting for them.
+    The job is owned by the calling process until it is finished.
+
+    Returns:
+        dict or None: The claimed job, or None if no job is due.
+    """
+    connection = get_connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        row = connection.execute(
+            "SELECT * FROM jobs WHERE status = 'queued'"
+            " AND COALESCE(scheduled, paused_until, 0) <= ?"
+            " ORDER BY COALESCE(scheduled, created) LIMIT 1",
+            (time.time(),),
+        ).fetchone()
+        if row is not None:
+            connection.execute(
+                "UPDATE jobs SET status = 'running', updated = ?, owner = ?,"
+                " scheduled = NULL, paused_until = NULL WHERE id = ?",
+                (time.time(), _get_owner(), row["id"]),
+            )
+        connection.execute("COMMIT")
+    except sqlite3.Error:
+        connection.execute("ROLLBACK")
+        raise
+    if row is None:
+        return None
+    job = dict(row)
+    job["payload"] = json.loads(job["payload"])
+    return job
+
+
+def get_job(job_id: str) -> dict | None:
+    """
+    Retrieves the state of a job.
+
+    Args:
+        job_id (str): The ID of the job.
+
+    Returns:
+        dict or None: The job without its payload, or None if it does not exist.
+    """
+    row = (
+        get_connection()
+        .execute(
+            "SELECT id, username, status, total, sent, failed, created, updated,"
+            " scheduled, delivered, read, replied FROM jobs WHERE id = ?",
+            (job_id,),
+        )
+        .fetchone()
+    )
+    if row is None:
+        return None
+    job = dict(row)
+    job["queued"] = job["total"] - job["sent"] - job["failed"]
+    return job
+
+
+def fill_outbox(job_id: str, rows: list[tuple[str, str, str, dict, str | None]]):
+    """
+    Stores the recipients of a job in the outbox and sets its total.
+
+    The rows are inserted in a single transaction, so a job is either fully
+    prepared or not at all.
+
+    Args:
+        job_id (str): The ID of the job.
+        rows (list): Tuples of phone, name, message key, contact and group name (or None).
+    """
+    connection = get_connection()
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        connection.executemany(
+            "INSERT OR IGNORE INTO outbox"
+            " (job_id, phone, name, message, contact, group_name)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (job_id, phone, name, message, json.dumps(contact), group_name)
+                for phone, name, message, contact, group_name in rows
+            ),
+        )
+        connection.execute(
+            "UPDATE jobs SET prepared = 1, updated = ?,"
+            " total = (SELECT COUNT(*) FROM outbox WHERE job_id = ?) WHERE id = ?",
+            (time.time(), job_id, job_id),
+        )
+
+
+def get_pending_messages(job_id: str, limit: int = -1) -> list[dict]:
+    """
+    Retrieves the recipients of a job that were not sent to yet.
+
+    Args:
+        job_id (str): The ID of the job.
+        limit (int, optional): The maximum number of recipients, -1 for all. Defaults to -1.
+
+    Returns:
+        list: The phone, name, message key, contact and group name of every pending recipient.
+    """
+    rows = (
+        get_connection()
+        .execute(
+            "SELECT phone, name, message, contact, group_name FROM outbox"
+            " WHERE job_id = ? AND state = 'pending' ORDER BY rowid LIMIT ?",
+            (job_id, limit),
+        )
+        .fetchall()
+    )
+    messages = []
+    for row in rows:
+        message = dict(row)
+        message["contact"] = json.loads(message["contact"])
+        messages.append(message)
+    return messages
+
+
+def mark_sending(job_id: str, phones: list[str]):
+    """
+    Marks recipients as being sent to, right before their requests are made.
+
+    Recipients that are still marked after a crash are not sent to again.
+
+    Args:
+        job_id (str): The ID of the job.
+        phones (list): The phone numbers of the recipients.
+    """
+    connection = get_connection()
+    with connection:
+        connection.execute("BEGIN")
+        connection.executemany(
+            "UPDATE outbox SET state = 'sending' WHERE job_id = ? AND phone = ?",
+            ((job_id, phone) for phone in phones),
+        )
+
+
+def add_job_results(job_id: str, results: list[tuple[str, bool, int, object]]):
+    """
+    Stores the results of recipients and adds them to the counters of a job.
+
+    The timestamp the API returns for a sent message is stored as well, as
+    receipts and replies refer to the message by it.
+
+    Args:
+        job_id (str): The ID of the job.
+        results (list): Tuples of phone, success status, HTTP status code and response data.
+    """
+    rows = []
+    sent = 0
+    for phone, ok, status, body in results:
+        sent_at = None
+        if isinstance(body, dict) and str(body.get("timestamp", "")).isdigit():
+            sent_at = int(body["timestamp"])
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        rows.append(
+            ["sent" if ok else "failed", status, body[:MAX_BODY_LENGTH], sent_at]
+        )
+        sent += int(ok)
+    connection = get_connection()
+    with connection:
+        connection.execute("BEGIN")
+        # Every call is numbered, so progress streams can ask for new results
+        connection.execute(
+            "UPDATE jobs SET sent = sent + ?, failed = failed + ?, updated = ?,"
+            " batches = batches + 1 WHERE id = ?",
+            (sent, len(rows) - sent, time.time(), job_id),
+        )
+        batch = connection.execute(
+            "SELECT batches FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()["batches"]
+        connection.executemany(
+            "UPDATE outbox SET state = ?, status = ?, body = ?, sent_at = ?,"
+            " batch = ? WHERE job_id = ? AND phone = ?",
+            (row + [batch, job_id, result[0]] for row, result in zip(rows, results)),
+        )
+    _notify_job_update()
+
+
+def iter_job_results(job_id: str):
+    """
+    Iterates over the stored results of a job without loading them all at once.
+
+    Args:
+        job_id (str): The ID of the job.
+
+    Yields:
+        dict: The phone, name, success status, HTTP status code, response and receipt times of a recipient.
+    """
+    cursor = get_connection().execute(
+        "SELECT phone, name, state = 'sent' AS ok, status, body,"
+        " delivered, read, replied FROM outbox"
+        " WHERE job_id = ? AND state IN ('sent', 'failed') ORDER BY rowid",
+        (job_id,),
+    )
+    for row in cursor:
+        result = dict(row)
+        result["ok"] = bool(result["ok"])
+        yield result
+
+
+def record_receipts(
+    receipts: list[tuple[str, str, list[int] | None, float]],
+) -> dict[str, int]:
+    """
+    Matches receipts and replies to the messages they refer to.
+
+    Messages are looked up by recipient and the timestamp the API returned
+    when sending them. Only the first receipt of each kind counts, and is
+    added to the counters of its job, so the counts never need to be
+    recomputed from the outbox. A read receipt also marks the message as
+    delivered. Replies that do not quote a message are matched to the last
+    message sent to the recipient within RECEIVE_REPLY_WINDOW seconds.
+
+    Args:
+        receipts (list): Tuples of phone, kind, timestamps of the messages (None for the last message) and Unix time of the receipt.
+
+    Returns:
+        dict: The number of newly matched messages, by kind.
+    """
+    counts = dict.fromkeys(RECEIPT_KINDS, 0)
+    window = app.config.get("RECEIVE_REPLY_WINDOW", 86400)
+    connection = get_connection()
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        for phone, kind, timestamps, when in receipts:
+            if timestamps is None:
+                rows = connection.execute(
+                    "SELECT rowid, job_id, delivered, read, replied FROM outbox"
+                    " WHERE phone = ? AND sent_at BETWEEN ? AND ?"
+                    " ORDER BY sent_at DESC LIMIT 1",
+                    (phone, int((when - window) * 1000), int(when * 1000)),
+                ).fetchall()
+            else:
+                rows = connection.execute(
+                    "SELECT rowid, job_id, delivered, read, replied FROM outbox"
+                    " WHERE phone = ? AND sent_at IN (%s)"
+                    % ",".join("?" * len(timestamps)),
+                    [phone] + timestamps,
+                ).fetchall()
+            for row in rows:
+                for column in ("delivered", kind) if kind == "read" else (kind,):
+                    if row[column] is not None:
+                        continue
+                    connection.execute(
+                        "UPDATE outbox SET %s = ? WHERE rowid = ?" % column,
+                        (when, row["rowid"]),
+                    )
+                    connection.execute(
+                        "UPDATE jobs SET %s = %s + 1 WHERE id = ?" % (column, column),
+                        (row["job_id"],),
+                    )
+                    counts[column] += 1
+    return counts
+
+
+def count_jobs() -> dict[str, tuple[int, int]]:
+    """
+    Counts the jobs and their unsent messages by status.
+
+    Returns:
+        dict: The number of jobs and of messages neither sent nor failed, by status.
+    """
+    return {
+        row["status"]: (row["jobs"], row["queued"])
+        for row in get_connection().execute(
+            "SELECT status, COUNT(*) AS jobs, SUM(total - sent - failed) AS queued"
+            " FROM jobs GROUP BY status"
+        )
+    }
+
+
+def get_job_results_since(job_id: str, batch: int = 0) -> tuple[list[dict], int]:
+    """
+    Retrieves the results of a job stored after the given batch.
+
+    Args:
+        job_id (str): The ID of the job.
+        batch (int, optional): The number of the last batch already seen. Defaults to 0.
+
+    Returns:
+        tuple: The new results in order of completion, and the number of the last batch.
+    """
+    results = []
+    for row in get_connection().execute(
+        "SELECT phone, name, state = 'sent' AS ok, status, body, batch FROM outbox"
+        " WHERE job_id = ? AND batch > ? ORDER BY batch, rowid",
+        (job_id, batch),
+    ):
+        result = dict(row)
+        result["ok"] = bool(result["ok"])
+        batch = max(batch, result.pop("batch"))
+        results.append(result)
+    return results, batch
+
+
+def get_active_jobs(username: str) -> list[dict]:
+    """
+    Retrieves the queued and running jobs of a user.
+
+    Args:
+        username (str): The user who created the jobs.
+
+    Returns:
+        list: The jobs without their payload, oldest first.
+    """
+    rows = (
+        get_connection()
+        .execute(
+            "SELECT id FROM jobs WHERE username = ?"
+            " AND status IN ('queued', 'running') ORDER BY created",
+            (username,),
+        )
+        .fetchall()
+    )
+    return [get_job(row["id"]) for row in rows]
+
+
+def get_next_scheduled_time() -> float | None:
+    """
+    Returns when the next scheduled or paused job is due.
+
+    Returns:
+        float or None: The Unix time of the next scheduled or paused job, or None if there is none.
+    """
+    return (
+        get_connection()
+        .execute(
+            "SELECT MIN(COALESCE(scheduled, paused_until)) FROM jobs"
+            " WHERE status = 'queued'"
+        )
+        .fetchone()[0]
+    )
+
+
+def release_job(job_id: str) -> bool:
+    """
+    Starts a scheduled job right away.
+
+    Args:
+        job_id (str): The ID of the job.
+
+    Returns:
+        bool: True if the job was released, False if it was not waiting.
+    """
+    cursor = get_connection().execute(
+        "UPDATE jobs SET scheduled = NULL, updated = ?"
+        " WHERE id = ? AND status = 'queued' AND scheduled IS NOT NULL",
+        (time.time(), job_id),
+    )
+    return cursor.rowcount > 0
+
+
+def cancel_job(job_id: str) -> bool:
+    """
+    Cancels a queued or running job.
+
+    A running job stops handing messages to the API client; messages already
+    in flight are still sent and recorded.
+
+    Args:
+        job_id (str): The ID of the job.
+
+    Returns:
+        bool: True if the job was cancelled, False if it had already finished.
+    """
+    cursor = get_connection().execute(
+        "UPDATE jobs SET status = 'cancelled', updated = ?"
+        " WHERE id = ? AND status IN ('queued', 'running')",
+        (time.time(), job_id),
+    )
+    _notify_job_update()
+    return cursor.rowcount > 0
+
+
+def wait_for_job_update(timeout: float):
+    """
+    Waits until a job of this process makes progress or the timeout expires.
+
+    Jobs of other processes do not wake up the caller, so callers check the
+    database again after the timeout.
+
+    Args:
+        timeout (float): The maximum number of seconds to wait.
+    """
+    with _job_updates:
+        _job_updates.wait(timeout)
+
+
+def _notify_job_update():
+    """
+    Wakes up everyone waiting for progress of a job.
+    """
+    with _job_updates:
+        _job_updates.notify_all()
+
+
+def pop_finished_jobs(username: str) -> list[dict]:
+    """
+    Returns the finished jobs of a user that were not reported to them yet.
+
+    Args:
+        username (str): The user who created the jobs.
+
+    Returns:
+        list: The finished jobs, oldest first.
+    """
+    connection = get_connection()
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        rows = connection.execute(
+            "SELECT id, status, total, sent, failed FROM jobs"
+            " WHERE username = ? AND notified = 0"
+            " AND status IN ('done', 'failed', 'cancelled')"
+            " ORDER BY created",
+            (username,),
+        ).fetchall()
+        connection.executemany(
+            "UPDATE jobs SET notified = 1 WHERE id = ?",
+            [(row["id"],) for row in rows],
+        )
+    return [dict(row) for row in rows]
+
+
+def pause_job(job_id: str, until: float):
+    """
+    Puts a running job back on the queue until a given time, unless it was cancelled.
+
+    Paced jobs are sent in releases, so they do not occupy a job worker
+    while waiting for the next one.
+
+    Args:
+        job_id (str): The ID of the job.
+        until (float): The Unix time before which the job is not claimed again.
+    """
+    get_connection().execute(
+        "UPDATE jobs SET status = 'queued', paused_until = ?, updated = ?,"
+        " owner = NULL WHERE id = ? AND status = 'running'",
+        (until, time.time(), job_id),
+    )
+
+
+def finish_job(job_id: str, status: str = "done"):
+    """
+    Marks a running job as finished, unless it was cancelled.
+
+    Args:
+        job_id (str): The ID of the job.
+        status (str, optional): The final status of the job. Defaults to "done".
+    """
+    get_connection().execute(
+        "UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND status = 'running'",
+        (status, time.time(), job_id),
+    )
+    _notify_job_update()
+
+
+def requeue_running_jobs() -> int:
+    """
+    Puts jobs back on the queue that were interrupted by a restart.
+
+    Only jobs of processes that are gone are requeued: those of an earlier
+    run of the application, and those of worker processes that died.
+
+    Recipients that were already sent to keep their results, so only the
+    pending recipients are sent to when the job is resumed. Recipients whose
+    request was in flight are marked as failed instead of risking a
+    duplicate message.
+
+    Returns:
+        int: The number of requeued jobs.
+    """
+    connection = get_connection()
+    owners = "SELECT id, owner FROM jobs WHERE status = 'running'"
+    # Usually every job has an owner, so check before locking the database
+    if all(_is_owner_alive(row["owner"]) for row in connection.execute(owners)):
+        return 0
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        job_ids = [
+            row["id"]
+            for row in connection.execute(owners)
+            if not _is_owner_alive(row["owner"])
+        ]
+        if not job_ids:
+            return 0
+        placeholders = ",".join("?" * len(job_ids))
+        connection.execute(
+            "UPDATE jobs SET failed = failed + (SELECT COUNT(*) FROM outbox"
+            " WHERE job_id = jobs.id AND state = 'sending'),"
+            " batches = batches + 1 WHERE id IN (%s)" % placeholders,
+            job_ids,
+        )
+        connection.execute(
+            "UPDATE outbox SET state = 'failed', status = 0, body = ?,"
+            " batch = (SELECT batches FROM jobs WHERE id = outbox.job_id)"
+            " WHERE state = 'sending' AND job_id IN (%s)" % placeholders,
+            [INTERRUPTED] + job_ids,
+        )
+        cursor = connection.execute(
+            "UPDATE jobs SET status = 'queued', updated = ?, owner = NULL"
+            " WHERE id IN (%s)" % placeholders,
+            [time.time()] + job_ids,
+        )
+    if cursor.rowcount:
+        logger.warning("Requeued %d interrupted jobs", cursor.rowcount)
+    return cursor.rowcount
+
+
+def _get_owner() -> str:
+    """
+    Returns the owner of the jobs claimed by this process.
+
+    Returns:
+        str: The ID of the application run and of the process.
+    """
+    return "%s:%d" % (INSTANCE_ID, os.getpid())
+
+
+def _is_owner_alive(owner: str | None) -> bool:
+    """
+    Checks whether the process owning a job is still running.
+
+    Args:
+        owner (str, optional): The owner of the job.
+
+    Returns:
+        bool: True if the owner is a running process of this application run.
+    """
+    if owner is None:
+        return False
+    instance, _, pid = owner.rpartition(":")
+    return instance == INSTANCE_ID and pid.isdigit() and is_process_alive(int(pid))
@@ -0,0 +1,325 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import copy
+import time
+from bisect import bisect_left
+from flask import g, request
+from logging import getLogger
+from threading import Lock, Thread
+
+from app import app
+from shared import get_other_worker_ids, get_shared, get_worker_id, set_shared
+
+logger = getLogger(__name__)
+
+# Buckets of histograms measuring requests and renders, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Buckets of histograms measuring whole broadcasts, in seconds
+BROADCAST_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+# Buckets of the recipients per second of broadcasts
+RATE_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Type, help text and histogram buckets of every metric
+METRICS = {
+    "signal_broadcaster_http_request_seconds": (
+        "histogram",
+        "Time spent handling requests to the web interface, by endpoint.",
+        LATENCY_BUCKETS,
+    ),
+    "signal_broadcaster_render_seconds": (
+        "histogram",
+        "Time spent rendering message templates.",
+        LATENCY_BUCKETS,
+    ),
+    "signal_broadcaster_api_request_seconds": (
+        "histogram",
+        "Latency of requests to the Signal API, by endpoint.",
+        LATENCY_BUCKETS,
+    ),
+    "signal_broadcaster_api_responses_total": (
+        "counter",
+        "Responses of the Signal API, by endpoint and status code.",
+        None,
+    ),
+    "signal_broadcaster_broadcast_seconds": (
+        "histogram",
+        "Duration of broadcasts, from being claimed until the last message.",
+        BROADCAST_BUCKETS,
+    ),
+    "signal_broadcaster_broadcast_recipients_per_second": (
+        "histogram",
+        "Recipients per second of finished broadcasts.",
+        RATE_BUCKETS,
+    ),
+    "signal_broadcaster_messages_total": (
+        "counter",
+        "Messages handled by broadcasts, by result and status code.",
+        None,
+    ),
+    "signal_broadcaster_receipts_total": (
+        "counter",
+        "Broadcast messages newly marked as delivered, read or replied to, by kind.",
+        None,
+    ),
+    "signal_broadcaster_jobs": (
+        "gauge",
+        "Broadcast jobs in the database, by status.",
+        None,
+    ),
+    "signal_broadcaster_queued_messages": (
+        "gauge",
+        "Messages of queued and running broadcasts that are not sent yet.",
+        None,
+    ),
+    "signal_broadcaster_api_circuit_open": (
+        "gauge",
+        "Whether the circuit breaker in front of the Signal API is open.",
+        None,
+    ),
+}
+
+# Values of every metric, by label set; histograms store their bucket
+# counts, sum and count
+_values: dict[str, dict[tuple, object]] = {name: {} for name in METRICS}
+_values_lock = Lock()
+
+# Key of the counters and histograms a worker process publishes for the
+# others, by worker ID
+PUBLISHED_KEY = "metrics:%d"
+
+
+def observe(name: str, value: float, **labels):
+    """
+    Adds an observation to a histogram.
+
+    Args:
+        name (str): The name of the histogram.
+        value (float): The observed value.
+        **labels: The labels of the observation.
+    """
+    buckets = METRICS[name][2]
+    key = tuple(sorted(labels.items()))
+    with _values_lock:
+        histogram = _values[name].get(key)
+        if histogram is None:
+            histogram = _values[name][key] = [[0] * len(buckets), 0.0, 0]
+        index = bisect_left(buckets, value)
+        if index < len(buckets):
+            histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def increment(name: str, amount: float = 1, **labels):
+    """
+    Increments a counter.
+
+    Args:
+        name (str): The name of the counter.
+        amount (float, optional): The amount to add. Defaults to 1.
+        **labels: The labels of the counter.
+    """
+    key = tuple(sorted(labels.items()))
+    with _values_lock:
+        _values[name][key] = _values[name].get(key, 0) + amount
+
+
+def set_gauge(name: str, value: float, **labels):
+    """
+    Sets the value of a gauge.
+
+    Args:
+        name (str): The name of the gauge.
+        value (float): The new value.
+        **labels: The labels of the gauge.
+    """
+    key = tuple(sorted(labels.items()))
+    with _values_lock:
+        _values[name][key] = value
+
+
+def get_average(name: str, **labels) -> float | None:
+    """
+    Returns the average of the observations of a histogram.
+
+    Args:
+        name (str): The name of the histogram.
+        **labels: The labels of the observations.
+
+    Returns:
+        float or None: The average, or None if nothing was observed yet.
+    """
+    histogram = _collect_values()[name].get(tuple(sorted(labels.items())))
+    if histogram is None or not histogram[2]:
+        return None
+    return histogram[1] / histogram[2]
+
+
+def start_metrics_publisher():
+    """
+    Starts a background thread that publishes the metrics of this process.
+
+    With several worker processes, every METRICS_PUBLISH_INTERVAL seconds
+    the counters and histograms are written to the shared store, so that
+    whichever worker answers a scrape reports the sum of all workers.
+    """
+    if not get_other_worker_ids():
+        return
+
+    def publish():
+        while True:
+            time.sleep(app.config.get("METRICS_PUBLISH_INTERVAL", 5))
+            try:
+                _publish_values()
+            except Exception as e:
+                logger.error("Failed to publish metrics: %s", e)
+
+    Thread(target=publish, name="metrics-publisher", daemon=True).start()
+
+
+def _publish_values():
+    """
+    Writes the counters and histograms of this process to the shared store.
+    """
+    with _values_lock:
+        data = {
+            name: [[key, value] for key, value in _values[name].items()]
+            for name, (kind, _, _) in METRICS.items()
+            if kind != "gauge"
+        }
+    set_shared(PUBLISHED_KEY % get_worker_id(), data)
+
+
+def _collect_values() -> dict[str, dict[tuple, object]]:
+    """
+    Sums the counters and histograms of all worker processes.
+
+    Gauges are taken from this process only, as they are set from the
+    database or describe the process itself.
+
+    Returns:
+        dict: The values of every metric, by label set.
+    """
+    with _values_lock:
+        values = copy.deepcopy(_values)
+    for worker_id in get_other_worker_ids():
+        data = get_shared(PUBLISHED_KEY % worker_id, {})
+        for name, items in data.items():
+            if name not in METRICS:
+                continue
+            for key, value in items:
+                key = tuple(tuple(label) for label in key)
+                current = values[name].get(key)
+                if current is None:
+                    values[name][key] = value
+                elif METRICS[name][0] == "histogram":
+                    current[0] = [a + b for a, b in zip(current[0], value[0])]
+                    current[1] += value[1]
+                    current[2] += value[2]
+                else:
+                    values[name][key] = current + value
+    return values
+
+
+def render_metrics() -> str:
+    """
+    Renders all metrics in the Prometheus text format.
+
+    Counters and histograms are summed over all worker processes.
+
+    Returns:
+        str: The metrics, one sample per line.
+    """
+    values = _collect_values()
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+        # Label values may be numbers or strings, e.g. status 200 or "timeout"
+        for key, value in sorted(
+            values[name].items(),
+            key=lambda item: [(label, str(value)) for label, value in item[0]],
+        ):
+            if kind != "histogram":
+                lines.append("%s%s %s" % (name, _format_labels(key), value))
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(
+                    "%s_bucket%s %d"
+                    % (name, _format_labels(key + (("le", bound),)), cumulative)
+                )
+            lines.append(
+                "%s_bucket%s %d"
+                % (name, _format_labels(key + (("le", "+Inf"),)), count)
+            )
+            lines.append("%s_sum%s %s" % (name, _format_labels(key), total))
+            lines.append("%s_count%s %d" % (name, _format_labels(key), count))
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(key: tuple) -> str:
+    """
+    Formats labels for the Prometheus text format.
+
+    Args:
+        key (tuple): The sorted label names and values.
+
+    Returns:
+        str: The labels in braces, or an empty string if there are none.
+    """
+    if not key:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"'
+        % (
+            label,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for label, value in key
+    )
+
+
+@app.before_request
+def _start_timer():
+    """
+    Remembers when handling the request started.
+    """
+    g.request_started = time.perf_counter()
+
+
+@app.teardown_request
+def _stop_timer(error=None):
+    """
+    Records the time spent handling the request, including the session.
+    """
+    started = g.pop("request_started", None)
+    if started is not None and request.endpoint not in ("metrics", "static"):
+        observe(
+            "signal_broadcaster_http_request_seconds",
+            time.perf_counter() - started,
+            endpoint=request.endpoint or "",
+        )
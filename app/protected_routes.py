@@ -19,26 +19,59 @@ along with Signal Broadcaster. If not, see
 """
 
 # Import necessary libraries and modules
+import csv
+import json
 import logging
 import requests
-from flask import flash, render_template, request, redirect, session, send_file, url_for
+import time
+import uuid
+from threading import BoundedSemaphore
+from flask import (
+    Response,
+    flash,
+    render_template,
+    request,
+    redirect,
+    session,
+    send_file,
+    url_for,
+)
 from flask_babel import gettext
-from io import BytesIO
+from io import BytesIO, StringIO
 
 from app import app
+from audience import select_contacts
+from jobs import (
+    cancel_job,
+    get_active_jobs,
+    get_job,
+    get_job_results_since,
+    iter_job_results,
+    release_job,
+    wait_for_job_update,
+)
 from functions import (
+    flash_finished_jobs,
     link_device,
     unlink_device,
     link_required,
     login_required,
+    parse_broadcast_form,
+    plan_broadcast,
+    search_recipients,
     send_message,
-    session_requests,
+    wake_job_workers,
 )
+from upstream import api_get
+from variables import get_snapshot
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Every progress stream occupies a thread of the process until its job ends
+_event_streams = BoundedSemaphore(max(app.config.get("EVENT_STREAMS", 8), 1))
+
 
 @app.route("/", endpoint="index")
 @login_required
@@ -50,9 +83,15 @@ async def index():
     Returns:
         str: The rendered HTML of the homepage template.
     """
+    flash_finished_jobs()
+    snapshot = get_snapshot()
     return render_template(
         "index.jinja",
         title=(gettext("Hello %(name)s") % {"name": session.get("name")}),
+        contacts_count=len(snapshot["contacts"]),
+        groups_count=len(snapshot["groups"]),
+        submission_id=uuid.uuid4().hex,
+        active_jobs=get_active_jobs(session.get("username", "")),
     )
 
 
@@ -72,20 +111,281 @@ async def help():
     )
 
 
+@app.route("/plan", methods=["POST"], endpoint="plan")
+@login_required
+@link_required
+async def plan():
+    """
+    Estimates the submitted broadcast without sending it.
+
+    Returns:
+        dict: The plan of the broadcast, or an error if the form is invalid.
+    """
+    try:
+        payload, _ = parse_broadcast_form()
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    return plan_broadcast(payload)
+
+
 @app.route("/send", methods=["POST"], endpoint="send")
 @login_required
 @link_required
 async def send():
     """
-    Handles sending messages to contacts and groups.
+    Queues a broadcast to contacts and groups.
 
     Returns:
-        str: A redirect to the homepage with flash messages indicating success or failure.
+        str: A redirect to the homepage with a flash message containing the job ID.
     """
     send_message()
     return redirect(url_for("index"))
 
 
+@app.route("/jobs/<job_id>", endpoint="job")
+@login_required
+async def job(job_id):
+    """
+    Reports the progress of a broadcast job.
+
+    Args:
+        job_id (str): The ID of the job.
+
+    Returns:
+        dict: The status of the job and its queued, sent and failed counts.
+    """
+    data = get_job(job_id)
+    if data is None or data["username"] != session.get("username"):
+        return {"error": gettext("Job not found.")}, 404
+    data["results"] = {
+        format: url_for("job_results", job_id=job_id, format=format)
+        for format in ("ndjson", "csv")
+    }
+    return data
+
+
+@app.route("/jobs/<job_id>/events", endpoint="job_events")
+@login_required
+async def job_events(job_id):
+    """
+    Streams the progress of a broadcast job as server-sent events.
+
+    A "results" event carries the recipients finished since the last event
+    and a "progress" event the counters whenever they change. The stream ends
+    with a "done" event once the job has finished. Reconnecting clients
+    continue after the Last-Event-ID they received. At most EVENT_STREAMS
+    streams are served per process at a time, so they cannot take up all
+    threads; further requests are answered with 503.
+
+    Args:
+        job_id (str): The ID of the job.
+
+    Returns:
+        Response: The event stream.
+    """
+    data = get_job(job_id)
+    if data is None or data["username"] != session.get("username"):
+        return {"error": gettext("Job not found.")}, 404
+    batch = request.headers.get("Last-Event-ID", 0, type=int)
+    # Busy processes let the page poll the job instead
+    if not _event_streams.acquire(blocking=False):
+        return (
+            {"error": gettext("Too many progress streams.")},
+            503,
+            {"Retry-After": "5"},
+        )
+
+    def generate():
+        last_batch = batch
+        progress = None
+        written = time.monotonic()
+        while True:
+            results, new_batch = get_job_results_since(job_id, last_batch)
+            job = get_job(job_id)
+            if results:
+                last_batch = new_batch
+                written = time.monotonic()
+                yield "id: %d\nevent: results\ndata: %s\n\n" % (
+                    last_batch,
+                    json.dumps(results),
+                )
+            state = (job["status"], job["total"], job["sent"], job["failed"])
+            if state != progress:
+                progress = state
+                written = time.monotonic()
+                yield "event: progress\ndata: %s\n\n" % json.dumps(job)
+            if job["status"] not in ("queued", "running"):
+                yield "event: done\ndata: %s\n\n" % json.dumps(job)
+                return
+            if time.monotonic() - written >= 15:
+                # Keeps proxies from closing an idle stream
+                written = time.monotonic()
+                yield ": keepalive\n\n"
+            wait_for_job_update(1)
+
+    response = Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # Called when the stream ends or the client goes away
+    response.call_on_close(_event_streams.release)
+    return response
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"], endpoint="cancel_job")
+@login_required
+async def cancel(job_id):
+    """
+    Cancels a queued or running broadcast job.
+
+    Args:
+        job_id (str): The ID of the job.
+
+    Returns:
+        dict or Response: Whether the job was cancelled, or a redirect to the homepage for plain form submissions.
+    """
+    data = get_job(job_id)
+    if data is None or data["username"] != session.get("username"):
+        return {"error": gettext("Job not found.")}, 404
+    cancelled = cancel_job(job_id)
+    if request.accept_mimetypes.best == "application/json":
+        return {"cancelled": cancelled}
+    if not cancelled:
+        flash(
+            gettext("Broadcast %(job_id)s has already finished.") % {"job_id": job_id},
+            "info",
+        )
+    return redirect(url_for("index"))
+
+
+@app.route("/jobs/<job_id>/release", methods=["POST"], endpoint="release_job")
+@login_required
+@link_required
+async def release(job_id):
+    """
+    Sends a scheduled broadcast job right away.
+
+    Args:
+        job_id (str): The ID of the job.
+
+    Returns:
+        Response: A redirect to the homepage.
+    """
+    data = get_job(job_id)
+    if data is None or data["username"] != session.get("username"):
+        return {"error": gettext("Job not found.")}, 404
+    if release_job(job_id):
+        wake_job_workers()
+    return redirect(url_for("index"))
+
+
+@app.route("/jobs/<job_id>/results.<any(ndjson, csv):format>", endpoint="job_results")
+@login_required
+async def job_results(job_id, format):
+    """
+    Streams the results of every recipient of a broadcast job.
+
+    Args:
+        job_id (str): The ID of the job.
+        format (str): Either "ndjson" or "csv".
+
+    Returns:
+        Response: The results, one recipient per line.
+    """
+    data = get_job(job_id)
+    if data is None or data["username"] != session.get("username"):
+        return {"error": gettext("Job not found.")}, 404
+
+    if format == "ndjson":
+
+        def generate():
+            for result in iter_job_results(job_id):
+                yield json.dumps(result) + "\n"
+
+        mimetype = "application/x-ndjson"
+    else:
+
+        def generate():
+            buffer = StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(
+                (
+                    "phone",
+                    "name",
+                    "ok",
+                    "status",
+                    "body",
+                    "delivered",
+                    "read",
+                    "replied",
+                )
+            )
+            for result in iter_job_results(job_id):
+                writer.writerow(result.values())
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            yield buffer.getvalue()
+
+        mimetype = "text/csv"
+
+    return Response(
+        generate(),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": "attachment; filename=%s.%s" % (job_id, format)
+        },
+    )
+
+
+@app.route("/recipients/<any(contacts, groups):kind>", endpoint="recipients")
+@login_required
+async def recipients(kind):
+    """
+    Searches contacts or groups for the recipient tables of the homepage.
+
+    Query parameters are q (search text), match ("prefix" or "substring"),
+    cursor, limit and any property to filter by, e.g. lang=de.
+
+    Args:
+        kind (str): Either "contacts" or "groups".
+
+    Returns:
+        dict: The items of the requested page and the cursor of the next page.
+    """
+    filters = {
+        key: value
+        for key, value in request.args.items()
+        if key not in ("q", "match", "cursor", "limit")
+    }
+    items, cursor = search_recipients(
+        kind,
+        query=request.args.get("q", ""),
+        match=request.args.get("match", "substring"),
+        filters=filters,
+        cursor=request.args.get("cursor", ""),
+        limit=min(max(request.args.get("limit", 50, type=int), 1), 500),
+    )
+    return {"items": items, "cursor": cursor}
+
+
+@app.route("/recipients/selector", endpoint="selector")
+@login_required
+async def selector():
+    """
+    Counts the contacts matching a selector, for the preview on the homepage.
+
+    Returns:
+        dict: The number of matching contacts, or an error if the selector is invalid.
+    """
+    try:
+        names = select_contacts(request.args.get("selector", ""), get_snapshot())
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    return {"count": len(names)}
+
+
 @app.route("/link", methods=["GET"], endpoint="link")
 @login_required
 async def link():
@@ -95,7 +395,7 @@ async def link():
     Returns:
         str: The rendered HTML of the link template, or redirects to the homepage if the device is already linked.
     """
-    if link_device():
+    if await link_device():
         return redirect(url_for("index"))
     return render_template(
         "link.jinja",
@@ -117,7 +417,7 @@ async def unlink():
         request.method == "POST"
         and request.form.get("unlink-device", "false") == "true"
     ):
-        unlink_device()
+        await unlink_device()
         return redirect(url_for("login"))
     return render_template(
         "unlink.jinja",
@@ -135,8 +435,10 @@ async def link_qrcode_png():
         Response: The QR code image, or a redirect to the link page if the QR code could not be generated.
     """
     try:
-        response = session_requests.get(
-            "http://api/v1/qrcodelink?device_name=" + app.config.get("APP_NAME")
+        response = await api_get(
+            "/v1/qrcodelink",
+            "qrcodelink",
+            params={"device_name": app.config.get("APP_NAME")},
         )
         response.raise_for_status()
         return send_file(
@@ -20,6 +20,7 @@ along with Signal Broadcaster. If not, see
 
 # Import necessary libraries and modules
 from flask import (
+    Response,
     render_template,
     request,
     redirect,
@@ -31,10 +32,13 @@ from flask_babel import gettext
 import logging
 
 from functions import (
-    get_accounts,
+    is_linked,
     login_user,
     logout_user,
 )
+from jobs import count_jobs
+from metrics import render_metrics, set_gauge
+from upstream import get_breaker_state
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -84,9 +88,8 @@ async def login():
         return redirect(url_for("index"))
     if request.method == "POST":
         if login_user():
-            for account in get_accounts():
-                if account == session["phone"]:
-                    return redirect(url_for("index"))
+            if await is_linked(session["phone"]):
+                return redirect(url_for("index"))
             return redirect(url_for("link"))
     return render_template(
         "login.jinja",
@@ -129,3 +132,25 @@ async def healthcheck():
         tuple: An empty response with a 204 status code.
     """
     return "", 204
+
+
+@app.route("/metrics", endpoint="metrics")
+async def metrics():
+    """
+    Exposes timings and counters in the Prometheus text format.
+
+    The gauges of the job queue are only computed when the endpoint is scraped.
+
+    Returns:
+        Response: The metrics as plain text.
+    """
+    jobs = count_jobs()
+    queued = 0
+    for status in ("queued", "running", "done", "failed", "cancelled"):
+        count, messages = jobs.get(status, (0, 0))
+        set_gauge("signal_broadcaster_jobs", count, status=status)
+        if status in ("queued", "running"):
+            queued += messages or 0
+    set_gauge("signal_broadcaster_queued_messages", queued)
+    set_gauge("signal_broadcaster_api_circuit_open", int(get_breaker_state() == "open"))
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,237 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from logging import getLogger
+
+from app import app
+from shared import get_shared, update_shared
+
+logger = getLogger(__name__)
+
+# The token buckets of the sender numbers and the retry budget are shared by
+# all worker processes, so their limits hold for the whole application
+BUCKET_KEY = "bucket:%s"
+RETRY_BUDGET_KEY = "retry_budget"
+
+
+async def acquire(phone: str):
+    """
+    Waits until the sender number may send the next request.
+
+    Every sender number has a token bucket which is refilled with its current
+    rate and holds up to SEND_BURST tokens.
+
+    Args:
+        phone (str): The phone number of the sender.
+    """
+    while True:
+        wait = _take_token(phone)
+        if wait <= 0:
+            return
+        await asyncio.sleep(wait)
+
+
+def report_success(phone: str):
+    """
+    Raises the rate of a sender number after a successful request.
+
+    Args:
+        phone (str): The phone number of the sender.
+    """
+
+    def update(bucket: dict[str, float]):
+        bucket["rate"] = min(
+            bucket["rate"] + app.config.get("SEND_RATE_INCREASE", 0.1),
+            app.config.get("SEND_RATE", 5),
+        )
+
+    update_shared(BUCKET_KEY % phone, _new_bucket(), update)
+
+
+def report_rate_limited(phone: str, retry_after: float | None = None):
+    """
+    Halves the rate of a sender number after the API answered 429.
+
+    Args:
+        phone (str): The phone number of the sender.
+        retry_after (float, optional): Seconds until the API accepts requests again. Defaults to None.
+    """
+
+    def update(bucket: dict[str, float]) -> float:
+        bucket["rate"] = max(bucket["rate"] / 2, app.config.get("SEND_RATE_MIN", 0.2))
+        bucket["tokens"] = 0
+        if retry_after:
+            bucket["blocked_until"] = max(
+                bucket["blocked_until"], time.monotonic() + retry_after
+            )
+        return bucket["rate"]
+
+    rate = update_shared(BUCKET_KEY % phone, _new_bucket(), update)
+    logger.warning(
+        "Rate limited, sending from %s with %.2f messages per second", phone, rate
+    )
+
+
+def get_rate(phone: str) -> float:
+    """
+    Returns the current rate of a sender number.
+
+    Args:
+        phone (str): The phone number of the sender.
+
+    Returns:
+        float: The number of requests per second.
+    """
+    return get_shared(BUCKET_KEY % phone, _new_bucket())["rate"]
+
+
+def deposit_retry_budget():
+    """
+    Adds the share of one request to the retry budget.
+    """
+
+    def update(budget: dict[str, float]):
+        budget["tokens"] = min(
+            budget["tokens"] + app.config.get("RETRY_BUDGET_RATIO", 0.2),
+            app.config.get("RETRY_BUDGET_MAX", 100),
+        )
+
+    update_shared(RETRY_BUDGET_KEY, _new_retry_budget(), update)
+
+
+def withdraw_retry_budget() -> bool:
+    """
+    Takes one retry from the retry budget.
+
+    Returns:
+        bool: True if the retry may be made, False if the budget is used up.
+    """
+
+    def update(budget: dict[str, float]) -> bool:
+        if budget["tokens"] < 1:
+            return False
+        budget["tokens"] -= 1
+        return True
+
+    return update_shared(RETRY_BUDGET_KEY, _new_retry_budget(), update)
+
+
+def backoff(attempt: int, retry_after: float | None = None) -> float:
+    """
+    Calculates the delay before the next attempt with full jitter.
+
+    Args:
+        attempt (int): The number of failed attempts so far, starting at 1.
+        retry_after (float, optional): The delay requested by the API. Defaults to None.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    delay = random.uniform(
+        0,
+        min(
+            app.config.get("SEND_BACKOFF_BASE", 0.5) * 2 ** (attempt - 1),
+            app.config.get("SEND_BACKOFF_MAX", 30),
+        ),
+    )
+    return max(delay, retry_after or 0)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Parses the Retry-After header of a response.
+
+    Args:
+        value (str, optional): The header value, in seconds or as HTTP date.
+
+    Returns:
+        float or None: The delay in seconds, or None if the header is missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _take_token(phone: str) -> float:
+    """
+    Takes a token from the bucket of a sender number if one is available.
+
+    Args:
+        phone (str): The phone number of the sender.
+
+    Returns:
+        float: Zero if a token was taken, otherwise the seconds until the next one.
+    """
+
+    def update(bucket: dict[str, float]) -> float:
+        # The monotonic clock is the same in all processes of the host
+        now = time.monotonic()
+        bucket["tokens"] = min(
+            bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"],
+            app.config.get("SEND_BURST", 10),
+        )
+        bucket["updated"] = now
+        if now >= bucket["blocked_until"] and bucket["tokens"] >= 1:
+            bucket["tokens"] -= 1
+            return 0
+        return max(
+            bucket["blocked_until"] - now,
+            (1 - bucket["tokens"]) / bucket["rate"],
+            0.001,
+        )
+
+    return update_shared(BUCKET_KEY % phone, _new_bucket(), update)
+
+
+def _new_bucket() -> dict[str, float]:
+    """
+    Returns a full token bucket for a sender number.
+
+    Returns:
+        dict: The tokens, rate and timestamps of the bucket.
+    """
+    return {
+        "tokens": app.config.get("SEND_BURST", 10),
+        "rate": app.config.get("SEND_RATE", 5),
+        "updated": time.monotonic(),
+        "blocked_until": 0.0,
+    }
+
+
+def _new_retry_budget() -> dict[str, float]:
+    """
+    Returns a full retry budget.
+
+    Returns:
+        dict: The tokens of the budget.
+    """
+    return {"tokens": app.config.get("RETRY_BUDGET_MAX", 100)}
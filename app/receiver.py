@@ -0,0 +1,179 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import time
+from logging import getLogger
+from threading import Thread
+
+from app import app
+from functions import get_accounts
+from jobs import record_receipts
+from metrics import increment
+from shared import is_first_worker
+from upstream import api_get, is_api_available, run_api_coroutine, wait_for_api
+from variables import get_snapshot, normalize_phone
+
+logger = getLogger(__name__)
+
+
+def start_receiver():
+    """
+    Starts a background thread that collects receipts and replies.
+
+    Every RECEIVE_INTERVAL seconds, the messages waiting for the linked
+    accounts are fetched from the API in batches of RECEIVE_BATCH_SIZE, until
+    none are left. Only the first worker process receives, as every message
+    is only delivered once.
+    """
+    interval = app.config.get("RECEIVE_INTERVAL", 10)
+    if interval <= 0 or not is_first_worker():
+        return
+
+    def receive():
+        while True:
+            if not is_api_available():
+                wait_for_api(interval)
+                continue
+            try:
+                accounts = run_api_coroutine(get_accounts()).result()
+                for account in accounts:
+                    while receive_messages(account) >= app.config.get(
+                        "RECEIVE_BATCH_SIZE", 100
+                    ):
+                        pass
+            except Exception as e:
+                logger.error("Failed to receive messages: %s", e)
+            time.sleep(interval)
+
+    Thread(target=receive, name="receiver", daemon=True).start()
+
+
+def receive_messages(account: str) -> int:
+    """
+    Fetches one batch of messages of an account and records their receipts.
+
+    Args:
+        account (str): The phone number of the linked account.
+
+    Raises:
+        requests.RequestException: If the request fails.
+
+    Returns:
+        int: The number of fetched messages.
+    """
+    response = run_api_coroutine(
+        api_get(
+            "/v1/receive/" + account,
+            "receive",
+            params={
+                "timeout": 1,
+                "ignore_attachments": "true",
+                "ignore_stories": "true",
+                "max_messages": app.config.get("RECEIVE_BATCH_SIZE", 100),
+            },
+        )
+    ).result()
+    response.raise_for_status()
+    messages = response.json()
+    counts = record_receipts(list(parse_messages(messages, get_snapshot()["phones"])))
+    for kind, count in counts.items():
+        if count:
+            increment("signal_broadcaster_receipts_total", count, kind=kind)
+    return len(messages)
+
+
+def parse_messages(messages: list[dict], phones: dict[str, dict]):
+    """
+    Extracts receipts and replies from received messages.
+
+    Messages from numbers that are not in the contacts are skipped, since
+    they cannot refer to a broadcast.
+
+    Args:
+        messages (list): The messages as returned by the receive endpoint.
+        phones (dict): The contacts by normalized phone number.
+
+    Yields:
+        tuple: The phone, kind, timestamps of the referred messages (None for the last message) and Unix time of every receipt.
+    """
+    for message in messages:
+        # A malformed message must not keep the others from being recorded
+        try:
+            receipt = _parse_message(message, phones)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            logger.warning("Skipping malformed message: %s", e)
+            continue
+        if receipt is not None:
+            yield receipt
+
+
+def _parse_message(message: dict, phones: dict[str, dict]) -> tuple | None:
+    """
+    Extracts the receipt or reply of a received message.
+
+    Args:
+        message (dict): The message as returned by the receive endpoint.
+        phones (dict): The contacts by normalized phone number.
+
+    Raises:
+        ValueError: If a timestamp of the message is malformed.
+        TypeError: If a field of the message has an unexpected type.
+        AttributeError: If a field of the message is no object.
+
+    Returns:
+        tuple or None: The phone, kind, timestamps of the referred messages (None for the last message) and Unix time, or None if the message is no receipt or reply of a contact.
+    """
+    envelope = message.get("envelope", None) if isinstance(message, dict) else None
+    if not isinstance(envelope, dict):
+        return None
+    phone = normalize_phone(envelope.get("sourceNumber") or envelope.get("source"))
+    contact = phones.get(phone, None)
+    if contact is None:
+        return None
+    when = envelope.get("timestamp", 0) / 1000
+
+    receipt = envelope.get("receiptMessage", None)
+    if receipt:
+        kind = "delivered"
+        if receipt.get("isRead", False) or receipt.get("isViewed", False):
+            kind = "read"
+        elif not receipt.get("isDelivery", False):
+            return None
+        return (
+            phone,
+            kind,
+            [int(timestamp) for timestamp in receipt.get("timestamps", [])],
+            receipt.get("when", envelope.get("timestamp", 0)) / 1000,
+        )
+
+    data = envelope.get("dataMessage", None)
+    if not data:
+        return None
+    # Quotes and reactions name the message they refer to
+    timestamps = None
+    if data.get("quote", None):
+        timestamps = [int(data["quote"].get("id", 0))]
+    elif data.get("reaction", None):
+        timestamps = [int(data["reaction"].get("targetSentTimestamp", 0))]
+    elif not data.get("message", None) and not data.get("attachments", None):
+        return None
+    logger.debug("Reply from %s", contact.get("name", phone))
+    return phone, "replied", timestamps, when
@@ -0,0 +1,214 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import copy
+import json
+import os
+import uuid
+from logging import getLogger
+from threading import Lock
+from typing import Callable
+
+from app import app
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+logger = getLogger(__name__)
+
+# Values of the process, used when not running in uWSGI or without its cache
+_values: dict[str, object] = {}
+_values_lock = Lock()
+
+
+def _has_cache() -> bool:
+    """
+    Checks whether the uWSGI cache named SHARED_CACHE is available.
+
+    Returns:
+        bool: True if values are shared between the worker processes.
+    """
+    if uwsgi is None:
+        return False
+    try:
+        uwsgi.cache_exists("", app.config.get("SHARED_CACHE", "shared"))
+    except Exception:
+        logger.warning(
+            "The uWSGI cache %s is not configured, state is not shared"
+            " between worker processes",
+            app.config.get("SHARED_CACHE", "shared"),
+        )
+        return False
+    return True
+
+
+_shared = _has_cache()
+
+# Identifies this run of the application; the workers of one uWSGI master
+# share it, also when they load the application themselves
+INSTANCE_ID = str(uwsgi.started_on) if uwsgi is not None else uuid.uuid4().hex
+
+
+def get_shared(key: str, default: object) -> object:
+    """
+    Returns a value shared by all worker processes.
+
+    Args:
+        key (str): The key of the value.
+        default (object): The value returned if the key is not set.
+
+    Returns:
+        object: A copy of the value, changes are not stored.
+    """
+    if not _shared:
+        with _values_lock:
+            return copy.deepcopy(_values.get(key, default))
+    data = uwsgi.cache_get(key, app.config.get("SHARED_CACHE", "shared"))
+    return json.loads(data) if data is not None else copy.deepcopy(default)
+
+
+def update_shared(key: str, default: object, update: Callable[[object], object]):
+    """
+    Changes a value shared by all worker processes.
+
+    The value is locked while update runs, so read, change and write are
+    atomic across threads and processes. Values must be serializable as JSON.
+
+    Args:
+        key (str): The key of the value.
+        default (object): The value passed to update if the key is not set.
+        update (Callable): Changes the value in place and returns the result.
+
+    Returns:
+        object: The result of update.
+    """
+    if not _shared:
+        with _values_lock:
+            if key not in _values:
+                _values[key] = copy.deepcopy(default)
+            return update(_values[key])
+
+    cache = app.config.get("SHARED_CACHE", "shared")
+    with _values_lock:
+        uwsgi.lock()
+        try:
+            data = uwsgi.cache_get(key, cache)
+            value = json.loads(data) if data is not None else copy.deepcopy(default)
+            result = update(value)
+            uwsgi.cache_update(key, json.dumps(value), 0, cache)
+        finally:
+            uwsgi.unlock()
+    return result
+
+
+def set_shared(key: str, value: object):
+    """
+    Replaces a value shared by all worker processes, without locking it.
+
+    Only for values written by a single process, e.g. under its worker ID.
+
+    Args:
+        key (str): The key of the value.
+        value (object): The new value, serializable as JSON.
+    """
+    if not _shared:
+        with _values_lock:
+            _values[key] = copy.deepcopy(value)
+        return
+    uwsgi.cache_update(
+        key, json.dumps(value), 0, app.config.get("SHARED_CACHE", "shared")
+    )
+
+
+def get_worker_id() -> int:
+    """
+    Returns the ID of this worker process.
+
+    Returns:
+        int: The uWSGI worker ID, starting at 1, or 0 if not running in uWSGI.
+    """
+    return uwsgi.worker_id() if uwsgi is not None else 0
+
+
+def get_other_worker_ids() -> list[int]:
+    """
+    Returns the IDs of the other worker processes sharing values with this one.
+
+    Returns:
+        list: The uWSGI worker IDs, empty if values are not shared.
+    """
+    if not _shared:
+        return []
+    return [
+        worker_id
+        for worker_id in range(1, uwsgi.numproc + 1)
+        if worker_id != uwsgi.worker_id()
+    ]
+
+
+def run_in_workers(function: Callable[[], None]):
+    """
+    Runs a function in every worker process.
+
+    When uWSGI loads the application in the master, threads started there do
+    not survive the fork, so the function runs after each worker was forked.
+    Otherwise it runs right away.
+
+    Args:
+        function (Callable): The function, e.g. starting background threads.
+    """
+    if uwsgi is not None and uwsgi.worker_id() == 0:
+        from uwsgidecorators import postfork
+
+        postfork(function)
+    else:
+        function()
+
+
+def is_first_worker() -> bool:
+    """
+    Checks whether this is the first worker process, or the only process.
+
+    Returns:
+        bool: True if tasks that must only run once should run here.
+    """
+    return uwsgi is None or uwsgi.worker_id() <= 1
+
+
+def is_process_alive(pid: int) -> bool:
+    """
+    Checks whether a process is still running.
+
+    Args:
+        pid (int): The ID of the process.
+
+    Returns:
+        bool: True if the process exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -22,29 +22,303 @@
 // checkboxes in the same column. It also ensures that when a checkbox in a row
 // is deselected, the corresponding checkbox in the header is updated accordingly.
 
-document.querySelectorAll('table input[type="checkbox"]').forEach((checkbox) => {
-  checkbox.addEventListener("input", () => {
-    // Find the column where the checkbox is located
-    const column = checkbox.closest("td, th");
-    // Determine the index of the column (1-based)
-    const nth = Array.from(column.parentElement.children).indexOf(column) + 1;
-    // Find the closest ancestor that is either a thead, tbody, or tfoot
-    const closest = checkbox.closest("thead, tbody, tfoot");
-
-    if (closest.nodeName.toLowerCase() !== "tbody") {
-      // If the checkbox is in the header or footer, update all checkboxes in that column
-      closest.parentElement
-        .querySelectorAll(`td:nth-child(${nth}) input[type="checkbox"], th:nth-child(${nth}) input[type="checkbox"]`)
-        .forEach((_checkbox) => {
-          _checkbox.checked = checkbox.checked;
-        });
-    } else {
-      // If the checkbox is in the body of the table, uncheck all checkboxes in the corresponding column
-      closest.parentElement
-        .querySelectorAll(`thead *:nth-child(${nth}) input[type=checkbox], tfoot *:nth-child(${nth}) input[type=checkbox]`)
-        .forEach((checkbox) => (checkbox.checked = false));
+document.addEventListener("input", (event) => {
+  const checkbox = event.target;
+  if (!checkbox.matches('table input[type="checkbox"]')) {
+    return;
+  }
+  // Find the column where the checkbox is located
+  const column = checkbox.closest("td, th");
+  // Determine the index of the column (1-based)
+  const nth = Array.from(column.parentElement.children).indexOf(column) + 1;
+  // Find the closest ancestor that is either a thead, tbody, or tfoot
+  const closest = checkbox.closest("thead, tbody, tfoot");
+
+  if (closest.nodeName.toLowerCase() !== "tbody") {
+    // If the checkbox is in the header or footer, update all checkboxes in that column
+    closest.parentElement
+      .querySelectorAll(`td:nth-child(${nth}) input[type="checkbox"], th:nth-child(${nth}) input[type="checkbox"]`)
+      .forEach((_checkbox) => {
+        _checkbox.checked = checkbox.checked;
+      });
+  } else {
+    // If the checkbox is in the body of the table, uncheck all checkboxes in the corresponding column
+    closest.parentElement
+      .querySelectorAll(`thead *:nth-child(${nth}) input[type=checkbox], tfoot *:nth-child(${nth}) input[type=checkbox]`)
+      .forEach((checkbox) => (checkbox.checked = false));
+  }
+});
+
+// The recipient tables load their rows page by page from the server. The next
+// page is loaded when the end of the table becomes visible, and the search
+// field in the header restarts the list with the matching rows.
+
+function createCell(tagName, ...children) {
+  const cell = document.createElement(tagName);
+  cell.append(...children);
+  return cell;
+}
+
+function createRow(table, item) {
+  const kind = table.dataset.source.split("/").pop();
+  const name = kind === "groups" ? "groups[]" : "contacts[]";
+  const id = (kind === "groups" ? "group" : "contact") + `[${item.name}]`;
+
+  const checkbox = document.createElement("input");
+  checkbox.type = "checkbox";
+  checkbox.id = id;
+  checkbox.name = name;
+  checkbox.value = item.name;
+  // Rows loaded after "select all" was checked are selected as well
+  checkbox.checked = table.querySelector('thead input[type="checkbox"]').checked;
+
+  const label = document.createElement("label");
+  label.htmlFor = id;
+  label.textContent = item.name;
+
+  const details = document.createElement("details");
+  details.append(createCell("summary", table.dataset.more));
+  for (const [prop, value] of Object.entries(item.props)) {
+    const bold = createCell("b", prop + ":");
+    details.append(createCell("div", bold, " " + value));
+    details.lastChild.className = "prop";
+  }
+
+  const row = document.createElement("tr");
+  row.append(createCell("td", checkbox), createCell("th", label));
+  if (kind === "groups") {
+    const more = item.size > item.members.length ? ", …" : "";
+    row.append(createCell("td", item.members.join(", ") + more));
+  } else {
+    row.append(createCell("td", item.lang), createCell("td", item.phone));
+  }
+  row.append(createCell("td", details));
+  return row;
+}
+
+document.querySelectorAll("table[data-source]").forEach((table) => {
+  const tbody = table.querySelector("tbody");
+  const button = table.querySelector(".load-more");
+  const search = table.querySelector(".search");
+  let cursor = "";
+  let loading = null;
+  let generation = 0;
+
+  function load() {
+    if (loading || cursor === null) {
+      return loading;
+    }
+    const current = generation;
+    const params = new URLSearchParams({ q: search.value, cursor });
+    loading = fetch(`${table.dataset.source}?${params}`)
+      .then((response) => response.json())
+      .then((data) => {
+        if (current !== generation) {
+          return;
+        }
+        tbody.append(...data.items.map((item) => createRow(table, item)));
+        cursor = data.cursor;
+        button.hidden = cursor === null;
+      })
+      .finally(() => {
+        if (current === generation) {
+          loading = null;
+        }
+      });
+    return loading;
+  }
+
+  function restart() {
+    generation++;
+    loading = null;
+    cursor = "";
+    tbody.replaceChildren();
+    load();
+  }
+
+  let timeout = null;
+  search.addEventListener("input", () => {
+    clearTimeout(timeout);
+    timeout = setTimeout(restart, 300);
+  });
+  // Do not submit the form when pressing enter in the search field
+  search.addEventListener("keydown", (event) => {
+    if (event.key === "Enter") {
+      event.preventDefault();
+      clearTimeout(timeout);
+      restart();
+    }
+  });
+  button.addEventListener("click", load);
+
+  if ("IntersectionObserver" in window) {
+    new IntersectionObserver((entries) => {
+      if (entries.some((entry) => entry.isIntersecting)) {
+        load();
+      }
+    }).observe(button);
+  }
+  load();
+});
+
+// The selector field shows how many contacts the selector currently matches.
+
+document.querySelectorAll("#selector").forEach((input) => {
+  const result = document.querySelector(".selector-result");
+  const count = result.querySelector(".selector-count");
+  let timeout = null;
+
+  input.addEventListener("input", () => {
+    clearTimeout(timeout);
+    timeout = setTimeout(async () => {
+      const params = new URLSearchParams({ selector: input.value });
+      const data = await fetch(`${input.dataset.source}?${params}`).then((response) => response.json());
+      result.classList.toggle("invalid", "error" in data);
+      result.title = data.error || "";
+      count.textContent = data.count ?? "?";
+    }, 300);
+  });
+});
+
+// The plan button shows what sending the broadcast would take, without
+// sending it. Attachments are left out, they do not change the plan.
+
+document.querySelectorAll(".button-plan").forEach((button) => {
+  const form = button.form;
+  const section = form.querySelector(".plan");
+
+  function formatDuration(seconds) {
+    if (seconds < 90) {
+      return `${Math.ceil(seconds)} s`;
+    }
+    if (seconds < 5400) {
+      return `${Math.ceil(seconds / 60)} min`;
+    }
+    return `${(seconds / 3600).toFixed(1)} h`;
+  }
+
+  button.addEventListener("click", async () => {
+    const body = new FormData(form);
+    body.delete("attachments");
+    button.disabled = true;
+    try {
+      const data = await fetch(button.dataset.source, {
+        method: "POST",
+        body,
+        headers: { Accept: "application/json" },
+      }).then((response) => response.json());
+      section.hidden = false;
+      section.classList.toggle("invalid", "error" in data);
+      section.querySelector(".plan-error").textContent = data.error || "";
+      if ("error" in data) {
+        return;
+      }
+      section.querySelector(".plan-recipients").textContent = data.recipients;
+      for (const key of ["de", "en", "mixed"]) {
+        section.querySelector(`.plan-${key}`).textContent = data.messages[key];
+      }
+      section.querySelector(".plan-senders").textContent = data.senders;
+      section.querySelector(".plan-requests").textContent = data.requests;
+      section.querySelector(".plan-duration").textContent = formatDuration(data.duration);
+      section.querySelector(".plan-failed").textContent = data.failed;
+      section.querySelector(".plan-sampled").textContent = data.sampled;
+      const samples = section.querySelector(".plan-samples");
+      samples.replaceChildren(
+        ...data.samples.map((sample) => {
+          const item = document.createElement("li");
+          item.className = sample.ok ? "ok" : "failed";
+          item.textContent = `${sample.name}: ${sample.message}`;
+          return item;
+        })
+      );
+    } finally {
+      button.disabled = false;
+    }
+  });
+});
+
+// Running broadcasts show their progress live. The server pushes the results
+// of the recipients and the counters as server-sent events, and the cancel
+// button stops the broadcast without leaving the page.
+
+document.querySelectorAll(".job-progress[data-events]").forEach((section) => {
+  const progress = section.querySelector("progress");
+  const log = section.querySelector(".job-log");
+  const form = section.querySelector(".job-cancel");
+  const source = new EventSource(section.dataset.events);
+
+  function update(job) {
+    progress.max = job.total || 1;
+    progress.value = job.sent + job.failed;
+    section.querySelector(".job-sent").textContent = job.sent;
+    section.querySelector(".job-failed").textContent = job.failed;
+    section.querySelector(".job-queued").textContent = job.queued;
+  }
+
+  source.addEventListener("results", (event) => {
+    for (const result of JSON.parse(event.data)) {
+      const item = document.createElement("li");
+      item.className = result.ok ? "ok" : "failed";
+      item.textContent = `${result.name} (${result.phone}): ${result.status}`;
+      log.prepend(item);
+    }
+    // Only keep the latest results on the page
+    while (log.children.length > 100) {
+      log.lastChild.remove();
     }
   });
+  function finish(job) {
+    update(job);
+    section.classList.add("finished");
+    form.hidden = true;
+  }
+
+  // Without a free stream on the server, the counters are polled instead
+  function poll() {
+    fetch(section.dataset.status)
+      .then((response) => response.json())
+      .then((job) => {
+        if (job.status === "queued" || job.status === "running") {
+          update(job);
+          setTimeout(poll, 5000);
+        } else {
+          finish(job);
+        }
+      })
+      .catch(() => setTimeout(poll, 5000));
+  }
+
+  source.addEventListener("progress", (event) => update(JSON.parse(event.data)));
+  source.addEventListener("done", (event) => {
+    source.close();
+    finish(JSON.parse(event.data));
+  });
+  source.addEventListener("error", () => {
+    // Closed for good when the server refused the stream, e.g. with 503
+    if (source.readyState === EventSource.CLOSED) {
+      poll();
+    }
+  });
+
+  form.addEventListener("submit", (event) => {
+    event.preventDefault();
+    form.querySelector("button").disabled = true;
+    fetch(form.action, {
+      method: "POST",
+      body: new FormData(form),
+      headers: { Accept: "application/json" },
+    });
+  });
+});
+
+// Scheduled times are entered and shown in the time zone of the browser.
+
+document.querySelectorAll("#timezone_offset").forEach((input) => {
+  input.value = new Date().getTimezoneOffset();
+});
+
+document.querySelectorAll("time[datetime]").forEach((time) => {
+  time.textContent = new Date(time.dateTime).toLocaleString();
 });
 
 setTimeout(() => {
@@ -0,0 +1,341 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import aiohttp
+import asyncio
+import os
+import requests
+import time
+from concurrent.futures import Future
+from logging import getLogger
+from requests.structures import CaseInsensitiveDict
+from threading import Condition, Lock, Thread
+from typing import Coroutine
+
+from app import app
+from metrics import increment, observe
+
+logger = getLogger(__name__)
+
+# The API client runs on its own event loop, so all threads and all async
+# views share one pool of keep-alive connections
+_client = {"loop": None, "session": None, "pid": None}
+_client_lock = Lock()
+
+# Read timeouts of the endpoints, by config key; others use API_READ_TIMEOUT
+READ_TIMEOUTS = {
+    "accounts": "API_ACCOUNTS_TIMEOUT",
+    "send": "API_SEND_TIMEOUT",
+}
+
+# Status codes that mean the API itself is unhealthy
+UNHEALTHY_STATUS_CODES = (502, 503, 504)
+
+# State of the circuit breaker in front of the API
+_breaker = {"state": "closed", "failures": 0, "opened": 0.0, "trial": False}
+_breaker_changed = Condition()
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """
+    Raised instead of sending a request while the API is considered down.
+    """
+
+
+def run_api_coroutine(coroutine: Coroutine) -> Future:
+    """
+    Runs a coroutine on the event loop of the API client.
+
+    The loop is started on first use, and again after the process was forked.
+
+    Args:
+        coroutine (Coroutine): The coroutine to run.
+
+    Returns:
+        Future: The future of the coroutine, usable from any thread.
+    """
+    with _client_lock:
+        if _client["pid"] != os.getpid():
+            loop = asyncio.new_event_loop()
+            Thread(target=loop.run_forever, name="api-client", daemon=True).start()
+            _client.update(loop=loop, session=None, pid=os.getpid())
+        loop = _client["loop"]
+    return asyncio.run_coroutine_threadsafe(coroutine, loop)
+
+
+async def api_get(path: str, endpoint: str = "default", **kwargs) -> requests.Response:
+    """
+    Sends a GET request to the API.
+
+    Args:
+        path (str): The path of the request, e.g. "/v1/accounts".
+        endpoint (str, optional): The name of the endpoint, selecting its timeout. Defaults to "default".
+
+    Returns:
+        requests.Response: The response of the API.
+    """
+    return await api_request("GET", path, endpoint, **kwargs)
+
+
+async def api_post(path: str, endpoint: str = "default", **kwargs) -> requests.Response:
+    """
+    Sends a POST request to the API.
+
+    Args:
+        path (str): The path of the request, e.g. "/v2/send".
+        endpoint (str, optional): The name of the endpoint, selecting its timeout. Defaults to "default".
+
+    Returns:
+        requests.Response: The response of the API.
+    """
+    return await api_request("POST", path, endpoint, **kwargs)
+
+
+async def api_request(
+    method: str, path: str, endpoint: str = "default", **kwargs
+) -> requests.Response:
+    """
+    Sends a request to the API through the circuit breaker.
+
+    The request is sent by the API client loop, so it can be awaited from
+    any event loop. After API_BREAKER_THRESHOLD consecutive connection errors,
+    timeouts or gateway errors the breaker opens and requests fail
+    immediately. After API_BREAKER_COOLDOWN seconds a single trial request is
+    let through, which closes the breaker again if it succeeds.
+
+    Args:
+        method (str): The HTTP method.
+        path (str): The path of the request.
+        endpoint (str, optional): The name of the endpoint, selecting its timeout. Defaults to "default".
+
+    Raises:
+        CircuitOpenError: If the breaker is open.
+        requests.RequestException: If the request fails.
+
+    Returns:
+        requests.Response: The response of the API.
+    """
+    if asyncio.get_running_loop() is _client["loop"]:
+        return await _request(method, path, endpoint, **kwargs)
+    return await asyncio.wrap_future(
+        run_api_coroutine(_request(method, path, endpoint, **kwargs))
+    )
+
+
+async def wait_for_api_async():
+    """
+    Waits without blocking the event loop until the circuit breaker lets requests through.
+    """
+    while not is_api_available():
+        with _breaker_changed:
+            wait = _cooldown_left()
+        await asyncio.sleep(min(max(wait, 0.1), 1))
+
+
+async def _request(
+    method: str, path: str, endpoint: str = "default", **kwargs
+) -> requests.Response:
+    """
+    Sends a request with the client of the API loop.
+
+    Must run on the API client loop. The response is returned as a
+    requests.Response, so callers handle it like a response of requests.
+
+    Args:
+        method (str): The HTTP method.
+        path (str): The path of the request.
+        endpoint (str, optional): The name of the endpoint, selecting its timeout. Defaults to "default".
+
+    Raises:
+        CircuitOpenError: If the breaker is open.
+        requests.RequestException: If the request fails.
+
+    Returns:
+        requests.Response: The response of the API.
+    """
+    try:
+        _before_request()
+    except CircuitOpenError:
+        increment(
+            "signal_broadcaster_api_responses_total",
+            endpoint=endpoint,
+            status="circuit_open",
+        )
+        raise
+    url = app.config.get("API_URL", "http://api") + path
+    started = time.perf_counter()
+    status = "error"
+    try:
+        if _client["session"] is None:
+            _client["session"] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=app.config.get("API_CONNECTION_LIMIT", 32)
+                )
+            )
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=app.config.get("API_CONNECT_TIMEOUT", 3),
+            sock_read=app.config.get(
+                READ_TIMEOUTS.get(endpoint, "API_READ_TIMEOUT"),
+                app.config.get("API_READ_TIMEOUT", 15),
+            ),
+        )
+        async with _client["session"].request(
+            method, url, timeout=timeout, **kwargs
+        ) as client_response:
+            response = requests.Response()
+            response.status_code = client_response.status
+            response.reason = client_response.reason
+            response.headers = CaseInsensitiveDict(client_response.headers)
+            response.url = str(client_response.url)
+            response.encoding = client_response.charset
+            response._content = await client_response.read()
+            status = response.status_code
+    except asyncio.TimeoutError as e:
+        status = "timeout"
+        _after_request(False)
+        raise requests.Timeout("Timeout while requesting %s" % url) from e
+    except aiohttp.ClientError as e:
+        _after_request(False)
+        raise requests.ConnectionError(str(e)) from e
+    except BaseException:
+        # Any other error, e.g. a cancellation, must not leave the trial request running
+        _after_request(False)
+        raise
+    finally:
+        observe(
+            "signal_broadcaster_api_request_seconds",
+            time.perf_counter() - started,
+            endpoint=endpoint,
+        )
+        increment(
+            "signal_broadcaster_api_responses_total", endpoint=endpoint, status=status
+        )
+    _after_request(response.status_code not in UNHEALTHY_STATUS_CODES)
+    return response
+
+
+def is_api_available() -> bool:
+    """
+    Checks whether the circuit breaker lets requests through.
+
+    Returns:
+        bool: True if the breaker is closed or a trial request is due.
+    """
+    with _breaker_changed:
+        return _breaker["state"] == "closed" or (
+            not _breaker["trial"] and _cooldown_left() <= 0
+        )
+
+
+def wait_for_api(timeout: float | None = None) -> bool:
+    """
+    Blocks until the circuit breaker lets requests through again.
+
+    Args:
+        timeout (float, optional): The maximum number of seconds to wait. Defaults to None.
+
+    Returns:
+        bool: True if requests may be sent, False if the timeout expired.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with _breaker_changed:
+        while True:
+            if _breaker["state"] == "closed":
+                return True
+            wait = _cooldown_left()
+            if wait <= 0 and not _breaker["trial"]:
+                return True
+            if deadline is not None:
+                if time.monotonic() >= deadline:
+                    return False
+                wait = min(wait, deadline - time.monotonic())
+            _breaker_changed.wait(max(wait, 0.1))
+
+
+def get_breaker_state() -> str:
+    """
+    Returns the state of the circuit breaker.
+
+    Returns:
+        str: Either "closed", "open" or "half-open".
+    """
+    with _breaker_changed:
+        return _breaker["state"]
+
+
+def _before_request():
+    """
+    Lets a request through the circuit breaker or rejects it.
+
+    Raises:
+        CircuitOpenError: If the breaker is open.
+    """
+    with _breaker_changed:
+        if _breaker["state"] == "closed":
+            return
+        if _breaker["trial"] or _cooldown_left() > 0:
+            raise CircuitOpenError("The Signal API is unavailable")
+        # Let one trial request through
+        _breaker["state"] = "half-open"
+        _breaker["trial"] = True
+
+
+def _after_request(healthy: bool):
+    """
+    Updates the circuit breaker with the outcome of a request.
+
+    Args:
+        healthy (bool): Whether the API answered properly.
+    """
+    with _breaker_changed:
+        if healthy:
+            if _breaker["state"] != "closed":
+                logger.info("The Signal API is available again")
+            _breaker.update(state="closed", failures=0, trial=False)
+            _breaker_changed.notify_all()
+            return
+        _breaker["failures"] += 1
+        if _breaker["state"] == "half-open" or _breaker["failures"] >= app.config.get(
+            "API_BREAKER_THRESHOLD", 5
+        ):
+            if _breaker["state"] == "closed":
+                logger.error(
+                    "The Signal API failed %d times, pausing requests",
+                    _breaker["failures"],
+                )
+            _breaker.update(state="open", opened=time.monotonic(), trial=False)
+            _breaker_changed.notify_all()
+
+
+def _cooldown_left() -> float:
+    """
+    Returns the seconds until the open breaker lets a trial request through.
+
+    Must be called with _breaker_changed held.
+
+    Returns:
+        float: The remaining seconds, zero or less if a trial is due.
+    """
+    return (
+        _breaker["opened"]
+        + app.config.get("API_BREAKER_COOLDOWN", 30)
+        - time.monotonic()
+    )
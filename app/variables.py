@@ -19,15 +19,180 @@ along with Signal Broadcaster. If not, see
 """
 
 # Import necessary libraries and modules
+import hashlib
+import os
+import pickle
+import re
+import time
 import yaml
+from logging import getLogger
+from threading import Thread
 
+from app import app
+from audience import build_property_index
 
-# Load user and contact information from YAML files
-with open("config/users.yaml", "r") as file:
-    users = yaml.safe_load(file)["users"]
+logger = getLogger(__name__)
 
-with open("config/contacts.yaml", "r") as file:
-    data: dict[str, list[dict[str, str]]] = yaml.safe_load(file)
+USERS_FILE = "config/users.yaml"
+CONTACTS_FILE = "config/contacts.yaml"
+
+# Bump when the structure of the snapshots changes
+SNAPSHOT_VERSION = b"4"
+
+# Use the C implementation of the YAML parser if PyYAML was built with it
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def normalize_phone(phone: str) -> str:
+    """
+    Normalizes a phone number, so that different spellings of the same number match.
+
+    Args:
+        phone (str): The phone number, e.g. "+49 123 456-789" or "0049123456789".
+
+    Returns:
+        str: The phone number without separators, e.g. "+49123456789".
+    """
+    phone = re.sub(r"[\s\-/().]", "", str(phone or ""))
+    if phone.startswith("00"):
+        phone = "+" + phone[2:]
+    return phone
+
+
+def hash_token(token: str) -> str:
+    """
+    Returns the digest an API token is looked up by.
+
+    Args:
+        token (str): The token.
+
+    Returns:
+        str: The hex digest of the token.
+    """
+    return hashlib.sha256(str(token).encode()).hexdigest()
+
+
+def get_snapshot() -> dict:
+    """
+    Returns the currently loaded users, contacts, groups and phones.
+
+    The snapshot is replaced as a whole when the configuration files change,
+    so callers should keep using one snapshot for one task.
+
+    Returns:
+        dict: The users list and the contacts, groups and phones dicts.
+    """
+    return _snapshot
+
+
+def load_snapshot() -> dict:
+    """
+    Loads users and contacts, preferring a cached snapshot of the same files.
+
+    The snapshot is cached as a pickle in DATA_DIR, named after the SHA-256 of
+    the YAML files, so the YAML files only have to be parsed after they have
+    been changed.
+
+    Returns:
+        dict: The users list and the contacts, groups and phones dicts.
+    """
+    with open(USERS_FILE, "rb") as file:
+        users_yaml = file.read()
+    with open(CONTACTS_FILE, "rb") as file:
+        contacts_yaml = file.read()
+    stats = _stat_files()
+
+    digest = hashlib.sha256(SNAPSHOT_VERSION)
+    digest.update(users_yaml)
+    digest.update(b"\0")
+    digest.update(contacts_yaml)
+    cache_dir = os.path.join(app.config.get("DATA_DIR", "data"), "cache")
+    cache_file = os.path.join(cache_dir, "contacts-%s.pickle" % digest.hexdigest())
+
+    try:
+        with open(cache_file, "rb") as file:
+            snapshot = pickle.load(file)
+        snapshot["stats"] = stats
+        return snapshot
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning("Ignoring broken contacts snapshot %s: %s", cache_file, e)
+
+    snapshot = _parse_snapshot(users_yaml, contacts_yaml)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for name in os.listdir(cache_dir):
+            if name.startswith("contacts-") and name.endswith(".pickle"):
+                os.remove(os.path.join(cache_dir, name))
+        with open(cache_file + ".tmp", "wb") as file:
+            pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_file + ".tmp", cache_file)
+    except OSError as e:
+        logger.warning("Failed to write contacts snapshot: %s", e)
+
+    snapshot["stats"] = stats
+    return snapshot
+
+
+def reload_snapshot() -> bool:
+    """
+    Reloads users and contacts if the configuration files were changed.
+
+    Returns:
+        bool: True if a new snapshot was loaded, False otherwise.
+    """
+    global _snapshot, _failed_stats
+    stats = _stat_files()
+    if stats == _snapshot.get("stats") or stats == _failed_stats:
+        return False
+    try:
+        snapshot = load_snapshot()
+    except Exception as e:
+        # Do not try again before the files are changed again
+        _failed_stats = stats
+        logger.error("Failed to reload contacts, keeping the old ones: %s", e)
+        return False
+    _snapshot = snapshot
+    logger.info(
+        "Reloaded %d users and %d contacts",
+        len(snapshot["users"]),
+        len(snapshot["contacts"]),
+    )
+    return True
+
+
+def start_contacts_watcher():
+    """
+    Starts a background thread that reloads changed configuration files.
+    """
+    interval = app.config.get("CONTACTS_RELOAD_INTERVAL", 10)
+    if interval <= 0:
+        return
+
+    def watch():
+        while True:
+            time.sleep(interval)
+            reload_snapshot()
+
+    Thread(target=watch, name="contacts-watcher", daemon=True).start()
+
+
+def _parse_snapshot(users_yaml: bytes, contacts_yaml: bytes) -> dict:
+    """
+    Parses the YAML configuration files.
+
+    Args:
+        users_yaml (bytes): The content of users.yaml.
+        contacts_yaml (bytes): The content of contacts.yaml.
+
+    Returns:
+        dict: The users list, the tokens, contacts, groups and phones dicts and the search indexes.
+    """
+    users = yaml.load(users_yaml, Loader=YamlLoader)["users"]
+
+    data: dict[str, list[dict[str, str]]] = yaml.load(contacts_yaml, Loader=YamlLoader)
     contacts = {contact["name"]: contact for contact in data.get("contacts", [])}
     groups: dict[str, dict[str, str | list[dict[str, str]]]] = {
         group["name"]: group for group in data.get("groups", [])
@@ -36,4 +201,52 @@ with open("config/contacts.yaml", "r") as file:
         group["members"] = [
             contacts.get(member, None) for member in group.get("members", [])
         ]
-    phones = {contact["phone"]: contact for contact in data.get("contacts", [])}
+    phones = {
+        normalize_phone(contact["phone"]): contact
+        for contact in data.get("contacts", [])
+    }
+
+    # API tokens by their digest, so they are never compared character-wise
+    tokens = {
+        hash_token(token): user
+        for user in users
+        for token in user.get("tokens", None) or []
+    }
+
+    # Names sorted by their case-folded form, for searching and paging
+    index = {
+        "contacts": sorted((name.casefold(), name) for name in contacts),
+        "groups": sorted((name.casefold(), name) for name in groups),
+    }
+
+    return {
+        "users": users,
+        "tokens": tokens,
+        "contacts": contacts,
+        "groups": groups,
+        "phones": phones,
+        "index": index,
+        "properties": build_property_index(contacts),
+    }
+
+
+def _stat_files() -> tuple:
+    """
+    Returns the modification times and sizes of the configuration files.
+
+    Returns:
+        tuple: The modification time and size of every configuration file.
+    """
+    stats = []
+    for path in (USERS_FILE, CONTACTS_FILE):
+        try:
+            stat = os.stat(path)
+            stats.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            stats.append(None)
+    return tuple(stats)
+
+
+# Load user and contact information on startup
+_snapshot = load_snapshot()
+_failed_stats = None
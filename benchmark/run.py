@@ -0,0 +1,496 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from stub_api import create_stub, start_stub
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), "app")
+
+SENDER = {"username": "admin", "password": "benchmark", "phone": "+4915000000000"}
+
+
+def percentile(samples: list[float], share: float) -> float:
+    """
+    Returns the percentile of a list of samples.
+
+    Args:
+        samples (list): The samples.
+        share (float): The percentile as share, e.g. 0.99.
+
+    Returns:
+        float: The sample at the percentile, or 0 if there are no samples.
+    """
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(int(share * len(samples)), len(samples) - 1)]
+
+
+def start_memory() -> int:
+    """
+    Starts measuring the memory of a scenario.
+
+    Returns:
+        int: The memory allocated by Python when the scenario starts, in bytes.
+    """
+    tracemalloc.reset_peak()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def peak_memory(start: int) -> float:
+    """
+    Returns the memory a scenario allocated at its peak.
+
+    Args:
+        start (int): The memory when the scenario started, as returned by start_memory.
+
+    Returns:
+        float: The peak memory above the start in MiB.
+    """
+    return max(tracemalloc.get_traced_memory()[1] - start, 0) / (1024 * 1024)
+
+
+def summarize(
+    name: str, size: int, latencies: list[float], elapsed: float, memory: int
+) -> dict:
+    """
+    Summarizes the latencies of a scenario.
+
+    Args:
+        name (str): The name of the scenario.
+        size (int): The number of contacts.
+        latencies (list): The latency of every operation in seconds.
+        elapsed (float): The wall time of the scenario in seconds.
+        memory (int): The memory when the scenario started, as returned by start_memory.
+
+    Returns:
+        dict: The throughput, latency percentiles and peak memory.
+    """
+    return {
+        "scenario": name,
+        "contacts": size,
+        "count": len(latencies),
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "peak_mib": peak_memory(memory),
+    }
+
+
+def write_config(size: int):
+    """
+    Writes synthetic users and contacts files to the current directory.
+
+    Every tenth contact is in a group of ten, contacts speak German, English
+    or no language and belong to one of four teams.
+
+    Args:
+        size (int): The number of contacts.
+    """
+    os.makedirs("config", exist_ok=True)
+    users = {"users": [dict(SENDER, name="Benchmark", lang="de")]}
+    contacts = [
+        {
+            "name": "Contact %06d" % i,
+            "phone": "+4916%09d" % i,
+            "lang": ("de", "en", None)[i % 3],
+            "team": ("ops", "dev", "sales", "support")[i % 4],
+        }
+        for i in range(size)
+    ]
+    groups = [
+        {
+            "name": "Group %05d" % i,
+            "members": [contact["name"] for contact in contacts[i * 10 : i * 10 + 10]],
+        }
+        for i in range(size // 10)
+    ]
+    with open("config/users.yaml", "w") as file:
+        yaml.safe_dump(users, file)
+    with open("config/contacts.yaml", "w") as file:
+        yaml.safe_dump({"contacts": contacts, "groups": groups}, file)
+
+
+def measure(function, count: int, concurrency: int = 1) -> tuple[list[float], float]:
+    """
+    Calls a function repeatedly and measures every call.
+
+    Args:
+        function (Callable): The function to call, without arguments.
+        count (int): The number of calls.
+        concurrency (int, optional): The number of threads calling it. Defaults to 1.
+
+    Returns:
+        tuple: The latency of every call and the wall time in seconds.
+    """
+
+    def timed(_):
+        start = time.perf_counter()
+        function()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed, range(count)))
+    return latencies, time.perf_counter() - start
+
+
+def run_size(size: int, args, client, modules: dict) -> list[dict]:
+    """
+    Runs all scenarios against a contacts file of the given size.
+
+    Args:
+        size (int): The number of contacts.
+        args (argparse.Namespace): The command line arguments.
+        client (FlaskClient): A client logged in as the benchmark user.
+        modules (dict): The imported app modules.
+
+    Returns:
+        list: The summary of every scenario.
+    """
+    functions, jobs, variables = (
+        modules["functions"],
+        modules["jobs"],
+        modules["variables"],
+    )
+    results = []
+
+    write_config(size)
+    memory = start_memory()
+    start = time.perf_counter()
+    variables.reload_snapshot()
+    elapsed = time.perf_counter() - start
+    results.append(summarize("load contacts", size, [elapsed], elapsed, memory))
+    memory = start_memory()
+    latencies, elapsed = measure(variables.load_snapshot, 3)
+    results.append(summarize("load cached contacts", size, latencies, elapsed, memory))
+
+    def get(path):
+        response = client.get(path)
+        assert response.status_code == 200, (path, response.status_code)
+
+    pages = {
+        "render index": lambda: get("/"),
+        "search contacts": lambda: get("/recipients/contacts?q=contact+00&limit=50"),
+        "search groups": lambda: get("/recipients/groups?q=group&limit=50"),
+        "count selector": lambda: get(
+            "/recipients/selector?selector=lang%3Dde+AND+NOT+team%3Dsales"
+        ),
+        "link qrcode": lambda: get("/link/qrcode.png"),
+    }
+    for name, page in pages.items():
+        memory = start_memory()
+        latencies, elapsed = measure(page, args.requests)
+        results.append(summarize(name, size, latencies, elapsed, memory))
+
+    # Unlinking logs the user out, so every request gets its own session
+    unlinking = []
+    for _ in range(args.requests):
+        unlinking.append(client.application.test_client())
+        unlinking[-1].post(
+            "/login",
+            data={"username": SENDER["username"], "password": SENDER["password"]},
+        )
+    unlinking = iter(unlinking)
+
+    def unlink():
+        response = next(unlinking).post("/unlink", data={"unlink-device": "true"})
+        assert response.status_code == 302, ("/unlink", response.status_code)
+
+    memory = start_memory()
+    latencies, elapsed = measure(unlink, args.requests)
+    results.append(summarize("unlink", size, latencies, elapsed, memory))
+
+    async def get_accounts():
+        await functions.get_accounts(0)
+
+    memory = start_memory()
+    latencies, elapsed = measure(
+        lambda: asyncio.run(get_accounts()), args.requests, args.concurrency
+    )
+    results.append(summarize("get_accounts", size, latencies, elapsed, memory))
+
+    sender = {"name": "Benchmark", "phone": SENDER["phone"]}
+    snapshot = variables.get_snapshot()
+    contacts = list(snapshot["contacts"].values())
+    sends = iter(range(args.requests))
+
+    def post():
+        contact = contacts[next(sends) % len(contacts)]
+        functions.run_api_coroutine(
+            functions._post_message(sender, "Hello", [contact["phone"]])
+        ).result()
+
+    memory = start_memory()
+    latencies, elapsed = measure(post, args.requests, args.concurrency)
+    results.append(summarize("_post_message", size, latencies, elapsed, memory))
+
+    # Renders and sends one personalized message per contact, without the job queue
+    tasks = [
+        ("Hello {{ contact.name }}", contacts[i % len(contacts)], None)
+        for i in range(args.requests)
+    ]
+    memory = start_memory()
+    start = time.perf_counter()
+    failed = sum(
+        not ok for _, (ok, _, _) in functions._dispatch_messages([sender], tasks)
+    )
+    elapsed = time.perf_counter() - start
+    result = summarize("_dispatch_messages", size, [], elapsed, memory)
+    result.update(count=len(tasks), throughput=len(tasks) / elapsed, failed=failed)
+    results.append(result)
+
+    broadcasts = {
+        "broadcast personalized": "Hello {{ contact.name }}",
+        "broadcast batched": "Hello everyone",
+    }
+    for name, message in broadcasts.items():
+        memory = start_memory()
+        start = time.perf_counter()
+        with client.session_transaction() as session:
+            flashes = len(session.get("_flashes", []))
+        client.post(
+            "/send",
+            data={
+                "message_de": message,
+                "message_en": message,
+                "contacts_all": "true",
+                "submission_id": "%s-%d-%s" % (name, size, time.time()),
+            },
+        )
+        with client.session_transaction() as session:
+            job_id = session["_flashes"][flashes][1].split()[1]
+        job = jobs.get_job(job_id)
+        while job["status"] in ("queued", "running"):
+            time.sleep(0.05)
+            job = jobs.get_job(job_id)
+        elapsed = time.perf_counter() - start
+        result = summarize(name, size, [], elapsed, memory)
+        result.update(
+            count=job["total"],
+            throughput=job["total"] / elapsed,
+            failed=job["failed"],
+        )
+        results.append(result)
+
+    return results
+
+
+def git_revision() -> str | None:
+    """
+    Returns the git revision of the benchmarked code.
+
+    Returns:
+        str or None: The abbreviated commit hash, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BENCHMARK_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: list[dict], baseline: list[dict] | None = None):
+    """
+    Prints the results as a table, with the change against a baseline run.
+
+    Args:
+        results (list): The summaries of the scenarios.
+        baseline (list, optional): The summaries of an earlier run. Defaults to None.
+    """
+    previous = {
+        (result["scenario"], result["contacts"]): result for result in baseline or []
+    }
+    print(
+        "%-24s %8s %8s %10s %10s %10s %9s %9s"
+        % (
+            "scenario",
+            "contacts",
+            "count",
+            "ops/s",
+            "p50 ms",
+            "p99 ms",
+            "peak MiB",
+            "change",
+        )
+    )
+    for result in results:
+        change = ""
+        before = previous.get((result["scenario"], result["contacts"]))
+        if before and before["throughput"]:
+            change = "%+.0f%%" % (
+                (result["throughput"] / before["throughput"] - 1) * 100
+            )
+        print(
+            "%-24s %8d %8d %10.1f %10.2f %10.2f %9.1f %9s"
+            % (
+                result["scenario"],
+                result["contacts"],
+                result["count"],
+                result["throughput"],
+                result["p50_ms"],
+                result["p99_ms"],
+                result["peak_mib"],
+                change,
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures Signal Broadcaster against a fake Signal API."
+    )
+    parser.add_argument(
+        "--sizes",
+        default="10,1000,10000",
+        help="comma separated numbers of synthetic contacts (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=200,
+        help="requests per page and API scenario (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=16,
+        help="threads calling the API scenarios (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.02,
+        help="seconds the fake API takes per request (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="share of requests answered with 503 (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rate-limit-rate",
+        type=float,
+        default=0.0,
+        help="share of sends answered with 429 (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output",
+        default=os.path.join(BENCHMARK_DIR, "results"),
+        help="directory the results are saved to (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--baseline", help="results file of an earlier run to compare with"
+    )
+    args = parser.parse_args()
+    args.output = os.path.abspath(args.output)
+    if args.baseline:
+        args.baseline = os.path.abspath(args.baseline)
+
+    stub = create_stub(
+        [SENDER["phone"]], args.latency, args.error_rate, args.rate_limit_rate
+    )
+    url = start_stub(stub)
+
+    # The app reads its configuration from the environment and the working
+    # directory when it is imported. Sending is not paced by default, so the
+    # app itself is measured and not the rate limit.
+    workdir = tempfile.mkdtemp(prefix="signal-broadcaster-benchmark-")
+    os.chdir(workdir)
+    write_config(0)
+    os.environ.update(
+        APP_API_URL=url,
+        APP_DATA_DIR=os.path.join(workdir, "data"),
+        APP_CONTACTS_RELOAD_INTERVAL="0",
+        APP_JOB_POLL_INTERVAL="0.1",
+    )
+    os.environ.setdefault("APP_SEND_RATE", "1000000")
+    os.environ.setdefault("APP_SEND_BURST", "1000000")
+    sys.path.insert(0, APP_DIR)
+
+    import app
+    import functions
+    import jobs
+    import variables
+
+    app.app.config["WTF_CSRF_ENABLED"] = False
+    client = app.app.test_client()
+    client.post(
+        "/login",
+        data={"username": SENDER["username"], "password": SENDER["password"]},
+    )
+    modules = {"functions": functions, "jobs": jobs, "variables": variables}
+
+    # Tracing slows the app down a little, but every scenario equally
+    tracemalloc.start()
+    results = []
+    for size in (int(size) for size in args.sizes.split(",")):
+        results.extend(run_size(size, args, client, modules))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+    print_results(results, baseline)
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(
+        args.output, "%s.json" % datetime.now().strftime("%Y%m%d-%H%M%S")
+    )
+    with open(path, "w") as file:
+        json.dump(
+            {
+                "created": datetime.now().isoformat(),
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "arguments": vars(args),
+                "stub": stub["stats"],
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    print("Saved results to %s" % path)
+
+
+if __name__ == "__main__":
+    main()
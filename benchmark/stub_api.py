@@ -0,0 +1,149 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import argparse
+import asyncio
+import random
+import time
+from aiohttp import web
+from threading import Event, Thread
+
+# A 1x1 pixel PNG, returned as QR code
+PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082"
+)
+
+
+def create_stub(
+    accounts: list[str],
+    latency: float = 0.0,
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+) -> web.Application:
+    """
+    Creates a fake of the signal-cli-rest-api endpoints used by the app.
+
+    Args:
+        accounts (list): The phone numbers reported as linked accounts.
+        latency (float, optional): Seconds every request takes. Defaults to 0.
+        error_rate (float, optional): Share of requests answered with 503. Defaults to 0.
+        rate_limit_rate (float, optional): Share of send requests answered with 429. Defaults to 0.
+
+    Returns:
+        web.Application: The application, with request counters in app["stats"].
+    """
+    stats = {"requests": 0, "messages": 0, "errors": 0, "rate_limited": 0}
+
+    async def delay() -> web.Response | None:
+        stats["requests"] += 1
+        if latency:
+            # Jitter the latency a little, like a real API would
+            await asyncio.sleep(random.uniform(latency * 0.5, latency * 1.5))
+        if random.random() < error_rate:
+            stats["errors"] += 1
+            return web.Response(status=503, text="Service Unavailable")
+        return None
+
+    async def get_accounts(request: web.Request) -> web.Response:
+        return await delay() or web.json_response(accounts)
+
+    async def send(request: web.Request) -> web.Response:
+        data = await request.json()
+        error = await delay()
+        if error is not None:
+            return error
+        if random.random() < rate_limit_rate:
+            stats["rate_limited"] += 1
+            return web.Response(
+                status=429, text="Too Many Requests", headers={"Retry-After": "1"}
+            )
+        stats["messages"] += len(data.get("recipients", []))
+        return web.json_response(
+            {"timestamp": str(int(time.time() * 1000))}, status=201
+        )
+
+    async def receive(request: web.Request) -> web.Response:
+        return await delay() or web.json_response([])
+
+    async def qrcodelink(request: web.Request) -> web.Response:
+        return await delay() or web.Response(body=PNG, content_type="image/png")
+
+    async def unregister(request: web.Request) -> web.Response:
+        return await delay() or web.Response(status=204)
+
+    # Accept attachments up to the size signal-cli-rest-api accepts
+    app = web.Application(client_max_size=150 * 1024 * 1024)
+    app["stats"] = stats
+    app.router.add_get("/v1/accounts", get_accounts)
+    app.router.add_post("/v2/send", send)
+    app.router.add_get("/v1/receive/{number}", receive)
+    app.router.add_get("/v1/qrcodelink", qrcodelink)
+    app.router.add_post("/v1/unregister/{number}", unregister)
+    return app
+
+
+def start_stub(app: web.Application, host: str = "127.0.0.1", port: int = 0) -> str:
+    """
+    Serves the stub in a background thread.
+
+    Args:
+        app (web.Application): The stub created by create_stub.
+        host (str, optional): The address to listen on. Defaults to "127.0.0.1".
+        port (int, optional): The port to listen on, 0 for a free one. Defaults to 0.
+
+    Returns:
+        str: The base URL of the stub.
+    """
+    started = Event()
+    address = {}
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(app, access_log=None)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, host, port)
+        loop.run_until_complete(site.start())
+        address["port"] = site._server.sockets[0].getsockname()[1]
+        started.set()
+        loop.run_forever()
+
+    Thread(target=serve, name="stub-api", daemon=True).start()
+    started.wait()
+    return "http://%s:%d" % (host, address["port"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serves a fake signal-cli-rest-api for load tests."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--account", action="append", default=[])
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(
+        create_stub(args.account, args.latency, args.error_rate, args.rate_limit_rate),
+        host=args.host,
+        port=args.port,
+    )
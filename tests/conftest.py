@@ -0,0 +1,54 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(ROOT_DIR, "app")
+
+
+def pytest_configure(config):
+    """
+    Prepares the working directory and environment the app is imported with.
+
+    The app reads its configuration from the environment and the working
+    directory when it is imported, so the tests run in a temporary directory
+    with the configuration templates. The API is not reachable.
+    """
+    workdir = tempfile.mkdtemp(prefix="signal-broadcaster-tests-")
+    os.makedirs(os.path.join(workdir, "config"))
+    for name in ("users.yaml", "contacts.yaml"):
+        shutil.copy(
+            os.path.join(ROOT_DIR, name + ".template"),
+            os.path.join(workdir, "config", name),
+        )
+    os.chdir(workdir)
+    os.environ.update(
+        APP_API_URL="http://127.0.0.1:9",
+        APP_DATA_DIR=os.path.join(workdir, "data"),
+    )
+    sys.path.insert(0, APP_DIR)
+
+    # The app has to be imported before the modules it registers
+    import app  # noqa: F401
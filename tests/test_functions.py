@@ -0,0 +1,64 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import functions
+from variables import _parse_snapshot
+
+USERS_YAML = b"""
+users:
+- username: admin
+  name: Max
+  phone: "+4912345678901"
+  lang: de
+  password: pw
+"""
+
+CONTACTS_YAML = b"""
+contacts:
+- name: Anna
+  phone: "+49 1111"
+  lang: de
+- name: Anna (Arbeit)
+  phone: "+491111"
+  lang: en
+groups:
+- name: Runde 1
+  members:
+    - Anna
+"""
+
+
+def test_resolve_audience_keeps_selected_contact_of_shared_number(monkeypatch):
+    snapshot = _parse_snapshot(USERS_YAML, CONTACTS_YAML)
+    monkeypatch.setattr(functions, "get_snapshot", lambda: snapshot)
+
+    anna = snapshot["contacts"]["Anna"]
+    assert functions.resolve_audience([], ["Anna"]) == {"+491111": (anna, None)}
+
+    group = snapshot["groups"]["Runde 1"]
+    assert functions.resolve_audience(["Runde 1"], ["Anna (Arbeit)"]) == {
+        "+491111": (anna, group)
+    }
+
+    work = snapshot["contacts"]["Anna (Arbeit)"]
+    assert functions.resolve_audience([], ["Anna (Arbeit)", "Anna"]) == {
+        "+491111": (work, None)
+    }
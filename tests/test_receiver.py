@@ -0,0 +1,56 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+from receiver import parse_messages
+
+PHONES = {"+491111": {"name": "Anna"}, "+492222": {"name": "Bob"}}
+
+
+def receipt(source: str, timestamps: list, when=1700000001000) -> dict:
+    """
+    Builds a delivery receipt as returned by the receive endpoint.
+    """
+    return {
+        "envelope": {
+            "sourceNumber": source,
+            "timestamp": when,
+            "receiptMessage": {
+                "isDelivery": True,
+                "timestamps": timestamps,
+                "when": when,
+            },
+        }
+    }
+
+
+def test_parse_messages_skips_malformed_envelope():
+    messages = [
+        receipt("+491111", [1700000000000]),
+        receipt("+492222", ["not a timestamp"]),
+        {"envelope": {"sourceNumber": "+492222", "timestamp": "yesterday"}},
+        {"envelope": {"sourceNumber": "+492222", "receiptMessage": ["broken"]}},
+        receipt("+492222", [1700000000000]),
+    ]
+
+    assert list(parse_messages(messages, PHONES)) == [
+        ("+491111", "delivered", [1700000000000], 1700000001.0),
+        ("+492222", "delivered", [1700000000000], 1700000001.0),
+    ]
@@ -0,0 +1,55 @@
+"""
+Signal Broadcaster - 2024
+Copyright (C) 2024 MPDieckmann
+This file is part of Signal Broadcaster.
+
+Signal Broadcaster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Signal Broadcaster is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Signal Broadcaster. If not, see
+<https://www.gnu.org/licenses/>.
+"""
+
+# Import necessary libraries and modules
+import asyncio
+import pytest
+import time
+
+import upstream
+
+
+class FailingSession:
+    """
+    A client session whose requests fail with an unexpected error.
+    """
+
+    def request(self, *args, **kwargs):
+        raise RuntimeError("Unexpected error")
+
+
+def test_unexpected_error_ends_trial_request(monkeypatch):
+    monkeypatch.setitem(upstream._client, "session", FailingSession())
+    monkeypatch.setattr(
+        upstream,
+        "_breaker",
+        {
+            "state": "open",
+            "failures": 5,
+            "opened": time.monotonic() - 3600,
+            "trial": False,
+        },
+    )
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(upstream._request("GET", "/v1/accounts", "accounts"))
+
+    assert upstream._breaker["state"] == "open"
+    assert upstream._breaker["trial"] is False